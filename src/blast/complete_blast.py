@@ -2,45 +2,189 @@ import os
 import pickle
 import json
 import argparse
-from src.blast.hashtable_generation_inference import consensus_seq_match
-from src.blast.ungapped_extension import ungapped_extension
+from src.blast.hashtable_generation_inference import load_table_data, score_seed_hits, two_hit_filter, \
+    batch_seed_hits
+from src.blast.ungapped_extension import ungapped_extension, batch_ungapped_extension
 from src.blast.gapped_extension import gapped_extension
+from src.blast.score_table import load_score_table
+from src.utils.reference_io import load_reference_matrix, load_contig_index
+from src.utils.utils import reverse_complement
 
 DEFAULT_BLAST_ARGS = json.load(open(os.path.join(os.path.dirname(__file__), 'config', 'default_blast_args.json'), 'r'))
+# strands searched for each value of seed_matching_args['strand']
+STRANDS = {
+    'forward': ['forward'],
+    'reverse': ['reverse'],
+    'both': ['forward', 'reverse']
+}
+# number of queries of ReferenceSession.search_many seeded at once
+QUERY_BATCH_SIZE = 1024
 
 
 # %%
-def blast(query, reference_matrix_file, seed_matching_args, ungapped_extension_args, gapped_extension_args):
-    # step 1 seed matching
+def locate_contigs(outputs, contig_index):
+    """
+    report positions as (contig, local position), seed_matching_result gets contig and contig_ref_idx, final_result
+    gets contig and its ref_left_idx / ref_right_idx become local to the contig (the other results keep global
+    reference positions)
+    :param outputs: gapped extension outputs
+    :param contig_index: ContigIndex of the reference
+    :return: outputs
+    """
+    for out in outputs:
+        seed_result = out['seed_matching_result']
+        seed_result['contig'], seed_result['contig_ref_idx'] = contig_index.locate(seed_result['ref_idx'])
+
+        final_result = out['final_result']
+        contig_id = int(contig_index.contig_of(final_result['ref_left_idx']))
+        contig_start = int(contig_index.offsets[contig_id])
+        final_result['contig'] = contig_index.names[contig_id]
+        final_result['ref_left_idx'] = final_result['ref_left_idx'] - contig_start
+        final_result['ref_right_idx'] = final_result['ref_right_idx'] - contig_start
+    return outputs
+
+
+class ReferenceSession(object):
+    """
+    load the reference matrix, the seed table and the blast configs once, then run any number of queries against them
+    usage:
+        session = ReferenceSession('src/data/reference_matrix.ref', **DEFAULT_BLAST_ARGS)
+        outputs = session.search(query)
+    """
+
+    def __init__(self, reference_matrix, seed_matching_args, ungapped_extension_args, gapped_extension_args,
+                 table_data=None, contig_index=None):
+        """
+        :param reference_matrix: reference matrix or reference matrix file (possibly with several records)
+        :param seed_matching_args: seed matching configs
+        :param ungapped_extension_args: ungapped extension configs
+        :param gapped_extension_args: gapped extension configs
+        :param table_data: loaded seed table data, if None load seed_matching_args['seed_table_file']
+        :param contig_index: ContigIndex of the reference, if None use the one stored with the reference matrix
+        """
+        self.reference_matrix = load_reference_matrix(reference_matrix)
+        if contig_index is None:
+            contig_index = load_contig_index(reference_matrix, self.reference_matrix)
+        self.contig_index = contig_index
+        if table_data is None:
+            table_data = seed_matching_args['seed_table_file']
+        self.table_data = load_table_data(table_data)
+        self.seed_matching_args = seed_matching_args
+        self.ungapped_extension_args = ungapped_extension_args
+        self.gapped_extension_args = gapped_extension_args
+        self.ungapped_score_table = self._load_score_table(reference_matrix, ungapped_extension_args)
+        self.gapped_score_table = self._load_score_table(reference_matrix, gapped_extension_args)
 
-    # load seed matching table data
-    table_path = seed_matching_args['seed_table_file']
-    table_data = pickle.load(open(table_path, 'rb'))
+    def _load_score_table(self, reference, extension_args):
+        """
+        :param reference: reference matrix or reference matrix file, score tables are saved next to the file
+        :param extension_args: ungapped or gapped extension configs
+        :return: score table of the scoring config of the stage if extension_args['score_table'] is set, else None
+        """
+        if not extension_args.get('score_table', False):
+            return None
+        return load_score_table(reference, extension_args['nt_score_method'], extension_args['mismatch_score'],
+                                extension_args['substitution'], self.reference_matrix)
 
-    outputs_step1 = consensus_seq_match(table_data, query)
+    def search(self, query):
+        """
+        run full blast for one query, on the strands given by seed_matching_args['strand'] (forward by default)
+        the seeds of both strands are looked up at once, then each strand is extended on its own and the outputs are
+        merged, final_result gets the strand of the match, query positions of reverse matches are positions in the
+        reverse complement of the query
+        :param query: query sequence of letters (ACGT)
+        :return: list of matches sorted by final score, positions of final results are local to their contig
+        """
+        return self.search_many([query])[0]
 
-    # step 2 ungapped matching
-    k = seed_matching_args['k']
-    delta = ungapped_extension_args['delta']
-    score_method = ungapped_extension_args['nt_score_method']
-    mismatch_score = ungapped_extension_args['mismatch_score']
-    substitution = ungapped_extension_args['substitution']
-    outputs_step2 = ungapped_extension(query, outputs_step1, reference_matrix_file, k, delta,
-                                       score_method, mismatch_score=mismatch_score, substitution=substitution)
+    def search_many(self, queries, batch_size=QUERY_BATCH_SIZE):
+        """
+        run full blast for several queries, the seeds of batch_size queries (and of their strands) are looked up
+        together, then the queries are extended one by one
+        :param queries: list of query sequences
+        :param batch_size: number of queries seeded at once
+        :return: list of search outputs, in the order of queries
+        """
+        strands = STRANDS[self.seed_matching_args.get('strand', 'forward')]
+        seed_matching_algorithm = self.seed_matching_args.get('seed_matching_algorithm', 'consensus_matching')
+        outputs = []
+        for start in range(0, len(queries), batch_size):
+            # step 1 seed matching
+            strand_queries = [query if strand == 'forward' else reverse_complement(query)
+                              for query in queries[start:start + batch_size] for strand in strands]
+            strand_hits = batch_seed_hits(self.table_data, strand_queries, seed_matching_algorithm,
+                                          self.seed_matching_args.get('max_occurrences'))
 
-    # step 3 gapped matching
-    score_method = gapped_extension_args['nt_score_method']
-    substitution = gapped_extension_args['substitution']
-    gap_penalty = gapped_extension_args['gap_penalty']
-    gap_bias = gapped_extension_args['gap_bias']
-    mismatch_score = gapped_extension_args['mismatch_score']
-    ref_max_length_factor = gapped_extension_args['ref_max_length_factor']
-    outputs_step3 = gapped_extension(query, reference_matrix_file, outputs_step2, score_method,
-                                     substitution, gap_penalty, gap_bias, mismatch_score, ref_max_length_factor)
+            for idx in range(0, len(strand_queries), len(strands)):
+                query_outputs = []
+                for strand, strand_query, seed_hits in zip(strands, strand_queries[idx:idx + len(strands)],
+                                                           strand_hits[idx:idx + len(strands)]):
+                    for out in self._extend(strand_query, seed_hits):
+                        out['final_result']['strand'] = strand
+                        query_outputs.append(out)
 
-    outputs_step3 = sorted(outputs_step3, key=lambda x: x['final_result']['score'] * -1)
+                query_outputs = sorted(query_outputs, key=lambda x: x['final_result']['score'] * -1)
+                outputs.append(locate_contigs(query_outputs, self.contig_index))
+        return outputs
 
-    return outputs_step3
+    def _extend(self, query, outputs_step1):
+        """
+        filter and extend the seed hits of one strand
+        :param query: query sequence of the strand
+        :param outputs_step1: structured array of seed hits of query
+        :return: gapped extension outputs
+        """
+        two_hit_window = self.seed_matching_args.get('two_hit_window')
+        if two_hit_window is not None:
+            outputs_step1 = two_hit_filter(outputs_step1, len(query), two_hit_window,
+                                           self.seed_matching_args.get('two_hit_min_query_length'))
+        seed_score_method = self.seed_matching_args.get('seed_score_method')
+        if seed_score_method is not None:
+            outputs_step1 = score_seed_hits(outputs_step1, query, self.reference_matrix, seed_score_method,
+                                            self.seed_matching_args.get('min_seed_score'),
+                                            self.seed_matching_args.get('max_seed_hits'))
+
+        # step 2 ungapped matching
+        k = self.seed_matching_args['k']
+        delta = self.ungapped_extension_args['delta']
+        score_method = self.ungapped_extension_args['nt_score_method']
+        mismatch_score = self.ungapped_extension_args['mismatch_score']
+        substitution = self.ungapped_extension_args['substitution']
+        # variable length seeds (SMEM) are scored over their span by default
+        score_seed = self.ungapped_extension_args.get('score_seed_span')
+        if score_seed is None:
+            score_seed = self.seed_matching_args.get('seed_matching_algorithm') == 'smem_matching'
+        extension_method = batch_ungapped_extension if self.ungapped_extension_args.get('batch', True) \
+            else ungapped_extension
+        outputs_step2 = extension_method(query, outputs_step1, self.reference_matrix, k, delta,
+                                         score_method, mismatch_score=mismatch_score, substitution=substitution,
+                                         contig_index=self.contig_index,
+                                         skip_covered=self.ungapped_extension_args.get('skip_covered_seeds', False),
+                                         score_table=self.ungapped_score_table, score_seed=score_seed)
+
+        # step 3 gapped matching
+        score_method = self.gapped_extension_args['nt_score_method']
+        substitution = self.gapped_extension_args['substitution']
+        gap_penalty = self.gapped_extension_args['gap_penalty']
+        gap_bias = self.gapped_extension_args['gap_bias']
+        mismatch_score = self.gapped_extension_args['mismatch_score']
+        ref_max_length_factor = self.gapped_extension_args['ref_max_length_factor']
+        return gapped_extension(query, self.reference_matrix, outputs_step2, score_method,
+                                substitution, gap_penalty, gap_bias, mismatch_score, ref_max_length_factor,
+                                contig_index=self.contig_index, score_table=self.gapped_score_table,
+                                max_candidates=self.gapped_extension_args.get('max_candidates', 100),
+                                min_ungapped_score=self.gapped_extension_args.get('min_ungapped_score'),
+                                relative_score_cutoff=self.gapped_extension_args.get('relative_score_cutoff'),
+                                band_width=self.gapped_extension_args.get('band_width'))
+
+
+def blast(query, reference_matrix_file, seed_matching_args, ungapped_extension_args, gapped_extension_args):
+    """
+    run full blast for one query, use ReferenceSession to run several queries without reloading the data
+    """
+    session = ReferenceSession(reference_matrix_file, seed_matching_args, ungapped_extension_args,
+                               gapped_extension_args)
+    return session.search(query)
 
 
 def parse_args():
@@ -95,16 +239,15 @@ def main():
         blast_configs = DEFAULT_BLAST_ARGS
 
     if args.hashtable_data_file is not None:
-        args['seed_matching_args']['seed_table_file'] = args.hashtable_data_file
+        blast_configs['seed_matching_args']['seed_table_file'] = args.hashtable_data_file
 
     reference_matrix_file = args.reference_matrix_file
 
     outputs = blast(query, reference_matrix_file, **blast_configs)
     for idx, out in enumerate(outputs):
-        print('{0}  ref_start_idx:{1},   ref_end_idx:{2},    score: {3}'.format(idx,
-                                                                                out['final_result']['ref_left_idx'],
-                                                                                out['final_result']['ref_right_idx'],
-                                                                                out['final_result']['score']))
+        print('{0}  contig:{1},   strand:{2},   ref_start_idx:{3},   ref_end_idx:{4},    score: {5}'.format(
+            idx, out['final_result']['contig'], out['final_result']['strand'], out['final_result']['ref_left_idx'],
+            out['final_result']['ref_right_idx'], out['final_result']['score']))
     result = {
         'query': query,
         'result': outputs
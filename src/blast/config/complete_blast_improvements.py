@@ -2,7 +2,7 @@ import os
 import pickle
 import json
 import argparse
-from src.blast.hashtable_generation_inference import consensus_seq_match
+from src.blast.hashtable_generation_inference import consensus_seq_match, load_table_data
 from src.blast.ungapped_extension import ungapped_extension
 from src.blast.gapped_extension_improvements import gapped_extension
 
@@ -15,7 +15,7 @@ def blast(query, reference_matrix_file, seed_matching_args, ungapped_extension_a
 
     # load seed matching table data
     table_path = seed_matching_args['seed_table_file']
-    table_data = pickle.load(open(table_path, 'rb'))
+    table_data = load_table_data(table_path)
 
     outputs_step1 = consensus_seq_match(table_data, query)
 
@@ -1,7 +1,7 @@
 from src.blast import ungapped_extension
-import pickle
 import numpy as np
 from src.utils.utils import sequence_one_hot
+from src.utils.reference_io import load_reference_matrix
 
 def gapped_alignment(query, reference, pos_q, pos_r, score_method, substitution,
                      mismatch_score, gap_penalty, gap_bias = 0, reverse = False):
@@ -21,7 +21,7 @@ def gapped_alignment(query, reference, pos_q, pos_r, score_method, substitution,
     
     :return: alignment strings, the position on the reference, and the score
     """
-    reference_matrix = pickle.load(open(reference, 'rb'))
+    reference_matrix = load_reference_matrix(reference)
     # reference_matrix = reference
     #Subset the query and reference matrix to get the parts to align
     #To reduce time, the length subsetted to the ref matrix is max 3 times the length of the sequence subset
@@ -199,7 +199,7 @@ def gapped_extension(query, reference, ungapped_dict, score_method,
     :return: gapped_extensions dict (positions, scores and strings)
     """
     gapped_extensions = dict()
-    reference_matrix = pickle.load(open(reference, 'rb'))
+    reference_matrix = load_reference_matrix(reference)
 
     for extension in ungapped_dict:
         # (tmp_pos_left_query, tmp_pos_right_query)] = [(tmp_pos_left_ref, tmp_pos_right_ref), tmp_score_left + tmp_score_right
@@ -1,6 +1,6 @@
 import numpy as np
-import pickle
 from src.blast.nw_proba_improvements import nw_affine_two
+from src.utils.reference_io import load_reference_matrix
 
 
 def clean_end_gaps(string_query, string_ref, score, gap_bias, gap_penalty):
@@ -76,7 +76,7 @@ def gapped_extension(query, reference, semigapped_dict, score_method,
     :return: gapped_extensions dict (positions, scores and strings)
     """
 
-    reference_matrix = pickle.load(open(reference, 'rb'))
+    reference_matrix = load_reference_matrix(reference)
     # reference_matrix = reference
     max_length = ref_max_length_factor * len(query)
 
@@ -188,7 +188,7 @@ def semigapped_extension(query, reference, ungapped_dict, score_method,
     :return: gapped_extensions dict (positions, scores and strings)
     """
 
-    reference_matrix = pickle.load(open(reference, 'rb'))
+    reference_matrix = load_reference_matrix(reference)
     # reference_matrix = reference
     max_length = ref_max_length_factor * len(query)
 
@@ -1,6 +1,6 @@
 import numpy as np
-import pickle
 from src.blast.nw_proba import nw_affine_two
+from src.utils.reference_io import load_reference_matrix
 
 
 
@@ -23,7 +23,7 @@ def gapped_extension(query, reference, ungapped_dict, score_method,
     """
 
     gapped_extensions = dict()
-    reference_matrix = pickle.load(open(reference, 'rb'))
+    reference_matrix = load_reference_matrix(reference)
     # reference_matrix = reference
     max_length = 3 * len(query)
 
@@ -1,6 +1,7 @@
+import heapq
 import numpy as np
-import pickle
 from src.blast.nw_proba import nw_affine_two
+from src.utils.reference_io import load_reference_matrix
 
 
 def clean_end_gaps(string_query, string_ref, score, gap_bias, gap_penalty):
@@ -27,10 +28,13 @@ def clean_end_gaps(string_query, string_ref, score, gap_bias, gap_penalty):
 
 
 def gapped_extension_one_side(seq_query, seq_ref, score_method,
-                              substitution_dict, gap_penalty, gap_bias, mismatch_score, side):
+                              substitution_dict, gap_penalty, gap_bias, mismatch_score, side, seq_ref_scores=None,
+                              band_width=None):
     if side == 'left':
         seq_query = seq_query[::-1]
         seq_ref = seq_ref[::-1]
+        if seq_ref_scores is not None:
+            seq_ref_scores = seq_ref_scores[::-1]
 
     if len(seq_ref) == 0:
         string_query = seq_query
@@ -42,7 +46,9 @@ def gapped_extension_one_side(seq_query, seq_ref, score_method,
                                                           gap_penalty, score_method,
                                                           substitution_dict,
                                                           offset=0, all_paths=False,
-                                                          mismatch_score=mismatch_score)
+                                                          mismatch_score=mismatch_score,
+                                                          seq2_scores=seq_ref_scores,
+                                                          band_width=band_width)
         try:
             string_query, string_ref, score = clean_end_gaps(string_query, string_ref, score, gap_bias,
                                                              gap_penalty)
@@ -58,25 +64,60 @@ def gapped_extension_one_side(seq_query, seq_ref, score_method,
     return string_query, string_ref, score, aligned
 
 
+def select_candidates(ungapped_dict, max_candidates=100, min_ungapped_score=None, relative_score_cutoff=None):
+    """
+    choose the ungapped extensions going through the gapped alignment
+    :param ungapped_dict: ungapped_extensions dict (positions and scores)
+    :param max_candidates: max number of candidates, the best ones are kept (heap selection, no full sort), None for all
+    :param min_ungapped_score: min ungapped extension score of the candidates, None for no min
+    :param relative_score_cutoff: keep the candidates scoring at least relative_score_cutoff x the best ungapped score
+    (only applied when the best score is positive), None for no cutoff
+    :return: candidates sorted by decreasing ungapped score, ties in input order
+    """
+    scores = [extension['ungapped_extension_result']['score'] for extension in ungapped_dict]
+    candidates = list(range(len(ungapped_dict)))
+    if min_ungapped_score is not None:
+        candidates = [idx for idx in candidates if scores[idx] >= min_ungapped_score]
+    if relative_score_cutoff is not None and len(candidates) > 0:
+        best_score = max(scores[idx] for idx in candidates)
+        if best_score > 0:
+            candidates = [idx for idx in candidates if scores[idx] >= relative_score_cutoff * best_score]
+    if max_candidates is None:
+        max_candidates = len(candidates)
+    # same order as sorted(...)[:max_candidates], the index breaks the ties
+    candidates = heapq.nsmallest(max_candidates, candidates, key=lambda idx: (-scores[idx], idx))
+    return [ungapped_dict[idx] for idx in candidates]
+
+
 def gapped_extension(query, reference, ungapped_dict, score_method,
-                     substitution_dict, gap_penalty, gap_bias, mismatch_score, ref_max_length_factor):
+                     substitution_dict, gap_penalty, gap_bias, mismatch_score, ref_max_length_factor,
+                     contig_index=None, score_table=None, max_candidates=100, min_ungapped_score=None,
+                     relative_score_cutoff=None, band_width=None):
     """
     compute a gapped alignment
     generates an alignment between the query and the reference sequences
 
     :param query: query sequence of letters (ACGT)
-    :param reference: reference matrix file
+    :param reference: reference matrix or reference matrix file
     :param ungapped_dict: ungapped_extensions dict (positions and scores)
     :param score_method: method used to compute extension score
     :param substitution_dict: stores the cost of replacing one letter by another (typically from BLOSUM matrices)
     :param gap_bias: cost for opening a gap, if affine function
     :param gap_penalty: cost of a gap in the alignment
     :param ref_max_length_factor:  do gapped extention of length FACTOR x ref_max_length_factor, if -1 use the adaptive method
+    :param contig_index: ContigIndex of the reference, extensions stop at the record boundaries
+    :param score_table: [#NT x 4] score table of (score_method, mismatch_score, substitution_dict), see
+    score_table.py, if None the scores are computed by score_method
+    :param max_candidates: max number of ungapped extensions aligned, see select_candidates
+    :param min_ungapped_score: min ungapped score of the aligned extensions
+    :param relative_score_cutoff: min ungapped score of the aligned extensions relative to the best one
+    :param band_width: band of the alignments around the diagonal of the ungapped extension, widened while the best
+    path touches its edge, full alignments if None
     :return: gapped_extensions dict (positions, scores and strings)
     """
 
-    reference_matrix = pickle.load(open(reference, 'rb'))
-    ungapped_dict = sorted(ungapped_dict, key=lambda x: -1 * x['ungapped_extension_result']['score'])[:100]
+    reference_matrix = load_reference_matrix(reference)
+    ungapped_dict = select_candidates(ungapped_dict, max_candidates, min_ungapped_score, relative_score_cutoff)
 
     gapped_extensions = []
 
@@ -93,6 +134,10 @@ def gapped_extension(query, reference, ungapped_dict, score_method,
         # reference left and right matching indices
         pos_l = ungapped_entry['ref_left_idx']
         pos_r = ungapped_entry['ref_right_idx']
+        if contig_index is None:
+            contig_start, contig_end = 0, len(reference_matrix)
+        else:
+            contig_start, contig_end = contig_index.bounds(contig_index.contig_of(pos_l))
 
         # right side
         string_query, string_ref, score = '', '', 0
@@ -106,11 +151,13 @@ def gapped_extension(query, reference, ungapped_dict, score_method,
                 extra_part = int(np.ceil(len(query) / 100) * 14)
                 max_length = min(len(seq_query) * 2 + 1, len(seq_query) + extra_part)
 
-            ref_boundary = pos_r + 1, pos_r + 1 + max_length
+            ref_boundary = pos_r + 1, min(pos_r + 1 + max_length, contig_end)
             seq_ref = reference_matrix[ref_boundary[0]: ref_boundary[1]]
+            seq_ref_scores = None if score_table is None else score_table[ref_boundary[0]: ref_boundary[1]]
             string_query, string_ref, score, aligned = gapped_extension_one_side(seq_query, seq_ref, score_method,
                                                                                  substitution_dict, gap_penalty,
-                                                                                 gap_bias, mismatch_score, 'right')
+                                                                                 gap_bias, mismatch_score, 'right',
+                                                                                 seq_ref_scores, band_width)
             if aligned:
                 ref_aligned_indices = pos_r + 1, pos_r + len(string_ref) - string_ref.count("-")
         right_alignment_result = {
@@ -131,12 +178,14 @@ def gapped_extension(query, reference, ungapped_dict, score_method,
             else:
                 extra_part = int(np.ceil(len(query) / 100) * 14)
                 max_length = min(len(seq_query) * 2 + 1, len(seq_query) + extra_part)
-            ref_boundary = max(0, pos_l - 1 - max_length), pos_l
+            ref_boundary = max(contig_start, pos_l - 1 - max_length), pos_l
             seq_ref = reference_matrix[ref_boundary[0]:ref_boundary[1]]
+            seq_ref_scores = None if score_table is None else score_table[ref_boundary[0]:ref_boundary[1]]
 
             string_query, string_ref, score, aligned = gapped_extension_one_side(seq_query, seq_ref, score_method,
                                                                                  substitution_dict, gap_penalty,
-                                                                                 gap_bias, mismatch_score, 'left')
+                                                                                 gap_bias, mismatch_score, 'left',
+                                                                                 seq_ref_scores, band_width)
             if aligned:
                 ref_aligned_indices = pos_l - (len(string_ref) - string_ref.count("-")), pos_l - 1
 
@@ -164,11 +213,12 @@ def gapped_extension(query, reference, ungapped_dict, score_method,
         }
 
         extension['gapped_extension_result'] = gapped_extension_result
+        # the seed score is already part of the ungapped score when the seed span was scored there
+        seed_score = 0 if 'seed_span_score' in ungapped_entry else extension['seed_matching_result']['score']
         final_result = {
             'ref_left_idx': gapped_extension_result['ref_left_idx'],
             'ref_right_idx': gapped_extension_result['ref_right_idx'],
-            'score': gapped_extension_result['score'] + extension['ungapped_extension_result']['score'] +
-                     extension['seed_matching_result']['score']
+            'score': gapped_extension_result['score'] + extension['ungapped_extension_result']['score'] + seed_score
         }
         extension['final_result'] = final_result
 
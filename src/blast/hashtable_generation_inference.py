@@ -1,15 +1,32 @@
 import numpy as np
 import pickle
-from src.utils.utils import seq2num
+from concurrent.futures import ProcessPoolExecutor
+from src.utils.utils import seq2num, sequence_codes
 from src.utils.registry import Registry
 from src.utils.utils import generate_sequence
+from src.utils.reference_io import load_reference_matrix, load_contig_index
+from src.utils.binary_format import read_magic
+from src.blast.seed_index import SeedIndex, consensus_sequence, kmer_codes, query_kmer_codes, position_dtype, \
+    letter_masks, window_kmer_counts, expand_kmer_codes, merge_seed_indexes, save_seed_index, open_seed_index, \
+    SEED_INDEX_MAGIC, pattern_shift, spaced_kmer_codes, spaced_seed_hits, occurrence_stats, minimizer_positions, \
+    minimizer_hits, make_seed_hits, seed_hits_to_matches
+from src.blast.suffix_array import SuffixArrayIndex, save_suffix_array, open_suffix_array, SUFFIX_ARRAY_MAGIC
+from src.utils.compact_reference import CompactReferenceMatrix
 
 HASHTABLE_SEEDING_ALGORITHM = Registry()
 HASHTABLE_MATCHING_ALGORITHM = Registry()
+# score of one NT of a seed out of the reference probability of the query letter, summed over the seed
+SEED_SCORE_ALGORITHM = Registry()
 
+# number of window starts handled by one shard of the seed table construction
+DEFAULT_SHARD_SIZE = 1 << 20
 
-@HASHTABLE_SEEDING_ALGORITHM.register('consensus_seed_seq')
-def consensus_seq_method(reference_matrix, k=11, characters="ACGT", **kwargs):
+# PatternHunter spaced seed, weight 11 over 18 NT
+DEFAULT_SEED_PATTERNS = ['111010010100110111']
+
+
+@HASHTABLE_SEEDING_ALGORITHM.register('consensus_seed_seq_dict')
+def consensus_seq_method(reference_matrix, k=11, characters="ACGT", contig_index=None, **kwargs):
     """
     method 1
     take the most likely sequence out of reference matrix, and directly building seed table
@@ -17,13 +34,17 @@ def consensus_seq_method(reference_matrix, k=11, characters="ACGT", **kwargs):
     :param reference_matrix: reference probability matrix
     :param k:  seed size
     :param characters: list of NT
+    :param contig_index: ContigIndex of the reference, seeds across record boundaries are not indexed
     :return:  seed table
     """
     consensus_seq = np.argmax(reference_matrix, axis=1)
+    window_mask = None if contig_index is None else contig_index.window_mask(k)
 
     table = {}
 
     for idx in range(len(consensus_seq) - k + 1):
+        if window_mask is not None and not window_mask[idx]:
+            continue
 
         seed = ''.join([characters[x] for x in consensus_seq[idx:idx + k]])
         if seed in table:
@@ -34,9 +55,30 @@ def consensus_seq_method(reference_matrix, k=11, characters="ACGT", **kwargs):
     return table
 
 
-@HASHTABLE_SEEDING_ALGORITHM.register('individual_nt_threshold')
+@HASHTABLE_SEEDING_ALGORITHM.register('consensus_seed_seq')
+def consensus_seq_index(reference_matrix, k=11, contig_index=None, **kwargs):
+    """
+    vectorized version of consensus_seq_method
+    rolling 2 bits codes of the k-mers of the most likely sequence, stored as a CSR SeedIndex
+
+    :param reference_matrix: reference probability matrix
+    :param k:  seed size
+    :param contig_index: ContigIndex of the reference, seeds across record boundaries are not indexed
+    :return:  SeedIndex
+    """
+    consensus_seq = consensus_sequence(reference_matrix)
+    codes = kmer_codes(consensus_seq, k)
+    positions = np.arange(len(codes))
+    if contig_index is not None:
+        window_mask = contig_index.window_mask(k)
+        codes = codes[window_mask]
+        positions = positions[window_mask]
+    return SeedIndex.from_pairs(k, codes, positions, position_dtype(len(consensus_seq)))
+
+
+@HASHTABLE_SEEDING_ALGORITHM.register('individual_nt_threshold_dict')
 def individual_nt_threshold(reference_matrix, k=11, threshold=0.15,
-                            characters="ACGT"):
+                            characters="ACGT", contig_index=None):
     """
     method 1
     take the most likely sequence out of reference matrix, and directly building seed table
@@ -44,9 +86,11 @@ def individual_nt_threshold(reference_matrix, k=11, threshold=0.15,
     :param reference_matrix: reference probability matrix
     :param k:  seed size
     :param threshold:  min proba to take into account a nucleotide
+    :param contig_index: ContigIndex of the reference, seeds across record boundaries are not indexed
     :return:  seed table
     """
     N = reference_matrix.shape[0]
+    window_mask = None if contig_index is None else contig_index.window_mask(k)
 
     table = {}
 
@@ -62,7 +106,8 @@ def individual_nt_threshold(reference_matrix, k=11, threshold=0.15,
     generate_sequence(above_threshold, k, current_seeds,
                       "", characters="ACGT")
 
-    for seed in current_seeds: table[seed] = [0]
+    if window_mask is None or window_mask[0]:
+        for seed in current_seeds: table[seed] = [0]
 
     for idx in range(1, N - k + 1):
         new_current_seeds = {seed[1:] for seed in current_seeds}
@@ -70,6 +115,8 @@ def individual_nt_threshold(reference_matrix, k=11, threshold=0.15,
         for char_idx in above_threshold[idx + k - 1]:
             current_seeds = current_seeds.union({s + characters[char_idx]
                                                  for s in new_current_seeds})
+        if window_mask is not None and not window_mask[idx]:
+            continue
         for seed in current_seeds:
             if seed in table:
                 table[seed].append(idx)
@@ -79,49 +126,477 @@ def individual_nt_threshold(reference_matrix, k=11, threshold=0.15,
     return table
 
 
-def hashtable_generation(reference_matrix_file, method, k, output_path="", **kwargs):
+@HASHTABLE_SEEDING_ALGORITHM.register('minimizer_seed_seq')
+def minimizer_seq_method(reference_matrix, k=11, w=10, contig_index=None, **kwargs):
+    """
+    (w, k) minimizers of the most likely sequence, about 2 / (w + 1) of the positions are indexed
+    every match of at least w + k - 1 NT with the most likely sequence is still hit
+
+    :param reference_matrix: reference probability matrix
+    :param k:  seed size
+    :param w:  number of consecutive k-mers per minimizer window
+    :param contig_index: ContigIndex of the reference, seeds across record boundaries are not indexed
+    :return:  SeedIndex
+    """
+    consensus_seq = consensus_sequence(reference_matrix)
+    codes = kmer_codes(consensus_seq, k)
+    valid = None if contig_index is None else contig_index.window_mask(k)
+    positions = minimizer_positions(codes, k, w, valid)
+    return SeedIndex.from_pairs(k, codes[positions], positions, position_dtype(len(consensus_seq)), window=w)
+
+
+@HASHTABLE_SEEDING_ALGORITHM.register('suffix_array')
+def suffix_array_method(reference_matrix, k=11, contig_index=None, **kwargs):
+    """
+    suffix array of the most likely sequence, queried with smem_match for exact matches of length >= k
+
+    :param reference_matrix: reference probability matrix
+    :param k:  min seed size
+    :param contig_index: ContigIndex of the reference, matches never cross record boundaries
+    :return:  SuffixArrayIndex
+    """
+    return SuffixArrayIndex.from_sequence(k, consensus_sequence(reference_matrix), contig_index)
+
+
+@HASHTABLE_SEEDING_ALGORITHM.register('spaced_seed_seq')
+def spaced_seed_method(reference_matrix, k=11, patterns=DEFAULT_SEED_PATTERNS, contig_index=None, **kwargs):
+    """
+    spaced seeds of the most likely sequence, several patterns can be stored in the same index
+    a spaced seed only requires matches at the '1' positions of its pattern, so it still hits queries with
+    substitutions where every contiguous k-mer is broken
+
+    :param reference_matrix: reference probability matrix
+    :param k: not used, the seed weights are given by the patterns
+    :param patterns: list of spaced seed patterns, e.g. ['111010010100110111', '11011000011000110111']
+    :param contig_index: ContigIndex of the reference, seeds across record boundaries are not indexed
+    :return:  SeedIndex
+    """
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    consensus_seq = consensus_sequence(reference_matrix)
+    shift = pattern_shift(patterns)
+
+    all_codes = []
+    all_positions = []
+    for pattern_id, pattern in enumerate(patterns):
+        codes = spaced_kmer_codes(consensus_seq, pattern) | (pattern_id << shift)
+        positions = np.arange(len(codes))
+        if contig_index is not None:
+            window_mask = contig_index.window_mask(len(pattern))
+            codes = codes[window_mask]
+            positions = positions[window_mask]
+        all_codes.append(codes)
+        all_positions.append(positions)
+
+    return SeedIndex.from_pairs(max(len(pattern) for pattern in patterns), np.concatenate(all_codes),
+                                np.concatenate(all_positions), position_dtype(len(consensus_seq)), patterns)
+
+
+def _threshold_shard(masks, consensus, start, k, max_seeds_per_window=None, window_mask=None):
+    """
+    seeds of one shard of the reference, the shard is followed by the k - 1 first positions of the next one
+    :param masks: letter bit masks of the shard
+    :param consensus: most likely letters of the shard
+    :param start: position of the shard in the reference
+    :param k: seed size
+    :param max_seeds_per_window: windows with more possible seeds only index their most likely seed
+    :param window_mask: window starts of the shard to index
+    :return: SeedIndex of the shard
+    """
+    sizes = window_kmer_counts(masks, k)
+    consensus_codes = kmer_codes(consensus, k)
+    expanded = sizes > 1
+    if max_seeds_per_window is not None:
+        expanded &= sizes <= max_seeds_per_window
+    single = ~expanded
+    if window_mask is not None:
+        expanded &= window_mask
+        single &= window_mask
+
+    codes, positions = expand_kmer_codes(masks, np.flatnonzero(expanded), k)
+    codes = np.concatenate([consensus_codes[single], codes])
+    positions = np.concatenate([np.flatnonzero(single), positions]) + start
+    return SeedIndex.from_pairs(k, codes, positions, np.int64)
+
+
+@HASHTABLE_SEEDING_ALGORITHM.register('individual_nt_threshold')
+def individual_nt_threshold_index(reference_matrix, k=11, threshold=0.15, max_seeds_per_window=None,
+                                  shard_size=DEFAULT_SHARD_SIZE, n_jobs=1, contig_index=None, **kwargs):
+    """
+    vectorized version of individual_nt_threshold
+    the k-mers of each window are enumerated as integer codes, the reference is cut in shards (with k - 1 positions
+    of overlap) built in parallel and merged in one SeedIndex
+
+    :param reference_matrix: reference probability matrix
+    :param k:  seed size
+    :param threshold:  min proba to take into account a nucleotide
+    :param max_seeds_per_window: windows with more possible seeds only index their most likely seed,
+    None to index every seed (same table as individual_nt_threshold)
+    :param shard_size: number of window starts per shard
+    :param n_jobs: number of processes
+    :param contig_index: ContigIndex of the reference, seeds across record boundaries are not indexed
+    :return:  SeedIndex
+    """
+    N = reference_matrix.shape[0]
+    blocks = [letter_masks(reference_matrix[start:start + shard_size], threshold) for start in range(0, N, shard_size)]
+    masks = np.concatenate([block[0] for block in blocks]) if N > 0 else np.zeros(0, dtype=np.uint8)
+    consensus = np.concatenate([block[1] for block in blocks]) if N > 0 else np.zeros(0, dtype=np.uint8)
+    window_mask = None if contig_index is None else contig_index.window_mask(k)
+
+    starts = list(range(0, max(N - k + 1, 0), shard_size))
+    args = (
+        [masks[start:start + shard_size + k - 1] for start in starts],
+        [consensus[start:start + shard_size + k - 1] for start in starts],
+        starts,
+        [k] * len(starts),
+        [max_seeds_per_window] * len(starts),
+        [None if window_mask is None else window_mask[start:start + shard_size] for start in starts]
+    )
+    if n_jobs > 1:
+        with ProcessPoolExecutor(n_jobs) as executor:
+            indexes = list(executor.map(_threshold_shard, *args))
+    else:
+        indexes = list(map(_threshold_shard, *args))
+    if len(indexes) == 0:
+        return SeedIndex.from_pairs(k, [], [], position_dtype(N))
+    return merge_seed_indexes(indexes, position_dtype(N))
+
+
+def hashtable_generation(reference_matrix_file, method='consensus_seed_seq', k=11, output_path="",
+                         max_occurrences=None, cap_mode='mask', **kwargs):
     """
     generate and store seed table for blast
     :param reference_matrix_file: reference matrix file
     :param method: table generation method
     :param k: seed size
-    :param output_path: output table storage path
+    :param output_path: output table storage path, .p outputs are legacy pickles, others are seed index files
+    :param max_occurrences: max number of reference positions per seed, None for no cap
+    :param cap_mode: 'mask' or 'sample' the seeds above max_occurrences, see SeedIndex.cap_occurrences
     :return: hashtable
     """
     assert method in HASHTABLE_SEEDING_ALGORITHM
-    reference_matrix = pickle.load(open(reference_matrix_file, 'rb'))
-    table = HASHTABLE_SEEDING_ALGORITHM[method](reference_matrix, k, **kwargs)
+    reference_matrix = load_reference_matrix(reference_matrix_file)
+    contig_index = load_contig_index(reference_matrix_file, reference_matrix)
+    table = HASHTABLE_SEEDING_ALGORITHM[method](reference_matrix, k, contig_index=contig_index, **kwargs)
     table_data = {
         'method': method,
         'hashtable': table,
-        'k': k
+        'k': table.k if isinstance(table, SeedIndex) else k,
+        'params': kwargs
     }
-    if output_path != "": pickle.dump(table_data, open(output_path, 'wb'))
+    if max_occurrences is not None:
+        assert not isinstance(table, SuffixArrayIndex), 'cap suffix array matches with max_occurrences in seed_matching_args (smem_match)'
+        if not isinstance(table, SeedIndex):
+            table = SeedIndex.from_dict(k, table)
+        table_data['stats'] = dict(occurrence_stats(table, max_occurrences), cap_mode=cap_mode)
+        table_data['hashtable'] = table.cap_occurrences(max_occurrences, cap_mode)
+    if output_path != "": save_table_data(table_data, output_path)
     return table_data
 
 
-def consensus_seq_match(table_data, query):
+def update_hashtable(table_data, reference_matrix_file, old_length, output_path=""):
+    """
+    index the positions appended to the reference after a seed table was built, the new windows (including the ones
+    across the old end of the reference) are indexed and merged into the table, same table as a full rebuild
+    :param table_data: table data of the reference of size old_length, SeedIndex tables without occurrence cap
+    :param reference_matrix_file: grown reference matrix file
+    :param old_length: number of NT of the reference when the table was built
+    :param output_path: output table storage path
+    :return: updated table data
+    """
+    table_data = load_table_data(table_data)
+    hashtable = table_data['hashtable']
+    assert isinstance(hashtable, SeedIndex), 'only SeedIndex tables can be updated'
+    assert len(hashtable.masked_codes) == 0, 'capped tables can not be updated, rebuild them'
+    reference_matrix = load_reference_matrix(reference_matrix_file)
+    contig_index = load_contig_index(reference_matrix_file, reference_matrix)
+    N = reference_matrix.shape[0]
+    assert old_length <= N
+    if old_length == N:
+        return table_data
+
+    # windows starting from here contain new positions, minimizer windows also reach back w - 1 k-mers
+    span = hashtable.k if hashtable.patterns is None else max(len(pattern) for pattern in hashtable.patterns)
+    if hashtable.window is not None:
+        span += hashtable.window - 1
+    start = max(old_length - span + 1, 0)
+
+    params = table_data.get('params', {})
+    tail = HASHTABLE_SEEDING_ALGORITHM[table_data['method']](reference_matrix[start:], hashtable.k,
+                                                              contig_index=contig_index.tail(start), **params)
+    # only the windows containing new positions are added, the old ones are already in the table
+    codes = np.repeat(tail.codes, tail.counts())
+    positions = tail.positions.astype(np.int64) + start
+    new = positions + span - 1 >= old_length if hashtable.window is None else np.ones(len(positions), dtype=bool)
+    table_data = dict(table_data, hashtable=hashtable.insert(codes[new], positions[new], position_dtype(N)))
+    if output_path != "": save_table_data(table_data, output_path)
+    return table_data
+
+
+def save_table_data(table_data, output_path):
+    """
+    store seed table data
+    :param table_data: table data dict with keys method, hashtable, k, params (and stats of capped tables)
+    :param output_path: output path, .p outputs are legacy pickles, others are seed index files (dict tables are
+    converted to SeedIndex)
+    """
+    if output_path.endswith('.p'):
+        pickle.dump(table_data, open(output_path, 'wb'))
+        return
+    hashtable = table_data['hashtable']
+    meta = {'params': table_data.get('params', {})}
+    if isinstance(hashtable, SuffixArrayIndex):
+        save_suffix_array(hashtable, output_path, table_data['method'], meta)
+        return
+    if not isinstance(hashtable, SeedIndex):
+        hashtable = SeedIndex.from_dict(table_data['k'], hashtable)
+    if 'stats' in table_data:
+        meta['stats'] = table_data['stats']
+    save_seed_index(hashtable, output_path, table_data['method'], meta)
+
+
+def load_table_data(table):
+    """
+    load seed table data
+    :param table: seed table file (seed index file, suffix array file or legacy pickle), or already loaded table data
+    which is returned as it is
+    :return: table data dict with keys method, hashtable, k, params (and stats of capped tables)
     """
+    if not isinstance(table, str):
+        return table
+    if read_magic(table) == SUFFIX_ARRAY_MAGIC:
+        meta, index = open_suffix_array(table)
+        return {
+            'method': meta['method'],
+            'hashtable': index,
+            'k': meta['k'],
+            'params': meta.get('params', {})
+        }
+    if read_magic(table) == SEED_INDEX_MAGIC:
+        meta, index = open_seed_index(table)
+        table_data = {
+            'method': meta['method'],
+            'hashtable': index,
+            'k': meta['k'],
+            'params': meta.get('params', {})
+        }
+        if 'stats' in meta:
+            table_data['stats'] = meta['stats']
+        return table_data
+    return pickle.load(open(table, 'rb'))
+
+
+@HASHTABLE_MATCHING_ALGORITHM.register('consensus_matching')
+def consensus_seq_hits(table_data, query):
+    """
+    all seed hits of a query, the query k-mers are encoded at once and looked up in bulk in SeedIndex tables
 
     :param table_data: hashtable data
     :param query: query sequence of letters (ACGT)
-    :return: list of dictionary with key query_start_idx,  reference_start_idx, match_score
+    :return: structured array of SEED_HIT_DTYPE (query_idx, ref_idx, score, seed_length)
     """
     hashtable = table_data['hashtable']
     k = table_data['k']
-    results = []
+    if isinstance(hashtable, SeedIndex) and hashtable.window is not None:
+        query_idx, ref_idx = minimizer_hits(hashtable, query)
+        return make_seed_hits(query_idx, ref_idx, k)
+
+    if isinstance(hashtable, SeedIndex) and hashtable.patterns is not None:
+        query_idx, ref_idx, seed_length = spaced_seed_hits(hashtable, query)
+        return make_seed_hits(query_idx, ref_idx, seed_length)
+
+    if isinstance(hashtable, SeedIndex):
+        codes, valid = query_kmer_codes(query, k)
+        query_idx = np.flatnonzero(valid)
+        match_idx, ref_idx = hashtable.search(codes[query_idx])
+        return make_seed_hits(query_idx[match_idx], ref_idx, k)
+
+    query_idx = []
+    ref_idx = []
     for idx in range(len(query) - k + 1):
         query_seed = query[idx:idx + k]
         matches = hashtable.get(query_seed, [])
-        if len(matches) > 0:
-            for db_index in matches:
-                results.append(
-                    {
-                        'seed_matching_result': {
-                            'query_idx': idx,
-                            'ref_idx': db_index,
-                            'score': 0  # for now score is set to 0
-                        }
-                    }
-                )
-    return results
+        query_idx += [idx] * len(matches)
+        ref_idx += list(matches)
+    return make_seed_hits(query_idx, ref_idx, k)
+
+
+def consensus_seq_match(table_data, query):
+    """
+
+    :param table_data: hashtable data
+    :param query: query sequence of letters (ACGT)
+    :return: list of dictionary with key query_start_idx,  reference_start_idx, match_score, seed_length
+    """
+    return seed_hits_to_matches(consensus_seq_hits(table_data, query))
+
+
+@HASHTABLE_MATCHING_ALGORITHM.register('smem_matching')
+def smem_hits(table_data, query, max_occurrences=None):
+    """
+    seeds are the super maximal exact matches of length >= k between the query and the most likely sequence
+
+    :param table_data: suffix array table data
+    :param query: query sequence of letters (ACGT)
+    :param max_occurrences: max number of reference positions per SMEM, None for all
+    :return: structured array of SEED_HIT_DTYPE (query_idx, ref_idx, score, seed_length)
+    """
+    index = table_data['hashtable']
+    assert isinstance(index, SuffixArrayIndex), 'smem_matching needs a suffix_array table'
+    smems = index.smems(query, table_data['k'], max_occurrences)
+    if len(smems) == 0:
+        return make_seed_hits([], [], table_data['k'])
+    query_idx = np.concatenate([np.full(len(positions), idx) for idx, _, positions in smems])
+    seed_length = np.concatenate([np.full(len(positions), length) for _, length, positions in smems])
+    ref_idx = np.concatenate([positions for _, _, positions in smems])
+    return make_seed_hits(query_idx, ref_idx, seed_length)
+
+
+def smem_match(table_data, query, max_occurrences=None):
+    """
+    :param table_data: suffix array table data
+    :param query: query sequence of letters (ACGT)
+    :param max_occurrences: max number of reference positions per SMEM, None for all
+    :return: list of dictionary with key query_start_idx,  reference_start_idx, match_score, seed_length
+    """
+    return seed_hits_to_matches(smem_hits(table_data, query, max_occurrences))
+
+
+def batch_seed_hits(table_data, queries, seed_matching_algorithm='consensus_matching', max_occurrences=None):
+    """
+    seed hits of a batch of queries (e.g. both strands of a read, or the queries of search_many), for contiguous
+    SeedIndex tables the distinct k-mers of the whole batch are joined once with the index (see SeedIndex.search) so
+    the index is read once per batch, the other tables are matched query by query
+    :param table_data: hashtable data
+    :param queries: list of query sequences
+    :param seed_matching_algorithm: matching method of HASHTABLE_MATCHING_ALGORITHM
+    :param max_occurrences: max number of reference positions per SMEM with smem_matching, None for all (k-mer tables
+    are capped when they are built, see hashtable_generation)
+    :return: list of structured arrays of SEED_HIT_DTYPE, the hits grouped by query in the order of queries
+    """
+    hashtable = table_data['hashtable']
+    if len(queries) == 0:
+        return []
+    if seed_matching_algorithm == 'smem_matching':
+        return [smem_hits(table_data, query, max_occurrences) for query in queries]
+    assert max_occurrences is None, 'cap k-mer tables with hashtable_generation max_occurrences'
+    if seed_matching_algorithm != 'consensus_matching' or not isinstance(hashtable, SeedIndex) or \
+            hashtable.window is not None or hashtable.patterns is not None:
+        return [HASHTABLE_MATCHING_ALGORITHM[seed_matching_algorithm](table_data, query) for query in queries]
+
+    k = table_data['k']
+    codes, query_idx, query_ids = [], [], []
+    for query_id, query in enumerate(queries):
+        query_codes, valid = query_kmer_codes(query, k)
+        positions = np.flatnonzero(valid)
+        codes.append(query_codes[positions])
+        query_idx.append(positions)
+        query_ids.append(np.full(len(positions), query_id, dtype=np.int64))
+    match_idx, ref_idx = hashtable.search(np.concatenate(codes))
+    hits = make_seed_hits(np.concatenate(query_idx)[match_idx], ref_idx, k)
+    # matches come in order of codes, so the hits of each query are contiguous
+    bounds = np.searchsorted(np.concatenate(query_ids)[match_idx], np.arange(len(queries) + 1))
+    return [hits[bounds[idx]:bounds[idx + 1]] for idx in range(len(queries))]
+
+
+# floor of the reference probabilities in seed scores, avoids log(0)
+MIN_SEED_PROBA = 1e-6
+
+
+@SEED_SCORE_ALGORITHM.register('log_odds')
+def log_odds_seed_score(letter_probs):
+    """
+    :param letter_probs: reference probabilities of the query letters
+    :return: log2 odds against a uniform background, sums to the log-odds of the seed
+    """
+    return np.log2(4 * np.maximum(letter_probs, MIN_SEED_PROBA))
+
+
+@SEED_SCORE_ALGORITHM.register('log_proba')
+def log_proba_seed_score(letter_probs):
+    """
+    :param letter_probs: reference probabilities of the query letters
+    :return: log probabilities, sums to the log of the joint probability of the seed
+    """
+    return np.log(np.maximum(letter_probs, MIN_SEED_PROBA))
+
+
+def reference_letter_probabilities(reference_matrix, positions, letters):
+    """
+    :param reference_matrix: reference matrix or CompactReferenceMatrix
+    :param positions: reference positions
+    :param letters: letter codes
+    :return: probability of each letter at its reference position
+    """
+    if isinstance(reference_matrix, CompactReferenceMatrix):
+        probs = reference_matrix.probabilities(positions)
+        return np.where(reference_matrix.codes(positions) == letters, probs, (1 - probs) / 3)
+    return np.asarray(reference_matrix[positions, letters])
+
+
+def score_seed_hits(hits, query, reference_matrix, seed_score_method='log_odds', min_seed_score=None,
+                    max_seed_hits=None):
+    """
+    score the seed hits out of the reference probabilities of the query letters, then prune them
+    :param hits: structured array of seed hits, see consensus_seq_hits
+    :param query: query sequence of letters (ACGT)
+    :param reference_matrix: reference matrix
+    :param seed_score_method: per NT seed score, see SEED_SCORE_ALGORITHM
+    :param min_seed_score: seeds with a lower score are dropped, None to keep them
+    :param max_seed_hits: only keep the best scoring seeds, None to keep them all
+    :return: kept hits with their score, in their original order
+    """
+    assert seed_score_method in SEED_SCORE_ALGORITHM
+    if len(hits) == 0:
+        return hits
+    lengths = hits['seed_length']
+
+    # one entry per NT of each seed
+    hit = np.repeat(np.arange(len(hits)), lengths)
+    offsets = np.arange(len(hit)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    letters = sequence_codes(query, invalid_code=4)[np.repeat(hits['query_idx'], lengths) + offsets]
+    positions = np.repeat(hits['ref_idx'], lengths) + offsets
+    valid = letters < 4
+    letter_probs = np.full(len(hit), 0.25)
+    letter_probs[valid] = reference_letter_probabilities(reference_matrix, positions[valid], letters[valid])
+    scores = np.bincount(hit, weights=SEED_SCORE_ALGORITHM[seed_score_method](letter_probs), minlength=len(hits))
+
+    keep = np.ones(len(hits), dtype=bool)
+    if min_seed_score is not None:
+        keep &= scores >= min_seed_score
+    if max_seed_hits is not None and np.sum(keep) > max_seed_hits:
+        kept = np.flatnonzero(keep)
+        keep[:] = False
+        keep[kept[np.argsort(-scores[kept], kind='stable')[:max_seed_hits]]] = True
+
+    hits = hits.copy()
+    hits['score'] = scores
+    return hits[keep]
+
+
+def two_hit_filter(hits, query_length, window, min_query_length=None):
+    """
+    BLAST two hit trigger: a seed is only extended when an earlier seed of the same diagonal (ref_idx - query_idx)
+    ends before it starts, at most window NT before
+    hits of queries shorter than min_query_length are all kept (single hit), longer queries with no triggered seed
+    get no hit
+    :param hits: structured array of seed hits
+    :param query_length: query length
+    :param window: max distance between the starts of the 2 seeds
+    :param min_query_length: shorter queries keep single hit seeding, if None use 2 * window
+    :return: triggered hits, in their original order
+    """
+    min_query_length = 2 * window if min_query_length is None else min_query_length
+    if len(hits) == 0 or query_length < min_query_length:
+        return hits
+
+    # each seed triggers the seeds of its diagonal starting in [query_idx + seed_length, query_idx + window]
+    diagonals = hits['ref_idx'] - hits['query_idx']
+    stride = query_length + window + 1
+    base = (diagonals - diagonals.min()) * stride
+    triggering = hits['seed_length'] <= window
+    trigger_starts = np.sort((base + hits['query_idx'] + hits['seed_length'])[triggering])
+    trigger_ends = np.sort((base + hits['query_idx'] + window)[triggering])
+    points = base + hits['query_idx']
+    covering = np.searchsorted(trigger_starts, points, side='right') - np.searchsorted(trigger_ends, points, side='left')
+    return hits[covering > 0]
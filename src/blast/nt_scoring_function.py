@@ -4,6 +4,7 @@ All nt scoring functions
 
 
 from src.utils.registry import Registry
+from src.utils.compact_reference import CompactReferenceMatrix, CONFIDENCE_SCALE, pack_codes
 import numpy as np
 
 NT_SCORE_ALGORITHM = Registry()
@@ -43,3 +44,189 @@ def sum_proba_score_correct0(ref_letter_prob, query_letter_one_hot, mismatch_sco
         score = max(score, 0)
 
     return score
+
+
+# batched forms of the NT_SCORE_ALGORITHM methods, they score arrays of reference rows against arrays of query letter
+# codes in one call: (ref_letter_probs [n x 4], query_codes [n], mismatch_score, substitution) -> [n] scores
+# a batched form is registered under the name of its scalar form and must give the same values, checked at registration
+NT_BATCH_SCORE_ALGORITHM = Registry()
+
+
+def _check_batch_form(score_method, batch_fn):
+    """
+    compare a batched scoring form with its scalar form on rows covering ties, uniform and one hot rows
+    :param score_method: method of NT_SCORE_ALGORITHM
+    :param batch_fn: batched form
+    """
+    assert score_method in NT_SCORE_ALGORITHM, 'register the scalar form of {0} first'.format(score_method)
+    rows = np.random.default_rng(0).dirichlet(np.ones(4), 32)
+    rows = np.concatenate([rows, np.eye(4), [[0.25] * 4, [0.1, 0.3, 0.3, 0.3], [0.4, 0.4, 0.1, 0.1],
+                                             [0.7, 0.1, 0.1, 0.1]]])
+    rows = np.repeat(rows, 4, axis=0)
+    query_codes = np.tile(np.arange(4), len(rows) // 4)
+    one_hot = np.eye(4, dtype=np.int64)
+    for mismatch_score in (1, 5):
+        expected = [NT_SCORE_ALGORITHM[score_method](row, one_hot[code], mismatch_score, dict())
+                    for row, code in zip(rows, query_codes)]
+        scores = batch_fn(rows, query_codes, mismatch_score, dict())
+        assert np.array_equal(scores, expected), 'batched and scalar forms of {0} disagree'.format(score_method)
+
+
+def register_batch_form(score_method):
+    """
+    decorator registering the batched form of score_method, after checking it against the scalar form
+    :param score_method: method of NT_SCORE_ALGORITHM
+    """
+    def register_fn(fn):
+        _check_batch_form(score_method, fn)
+        return NT_BATCH_SCORE_ALGORITHM.register(score_method)(fn)
+
+    return register_fn
+
+
+@register_batch_form('sum_proba_score')
+def batch_sum_proba_score(ref_letter_probs, query_codes, mismatch_score=1, substitution=dict()):
+    """
+    batched sum_proba_score, the terms are summed in the same order
+    :param ref_letter_probs: [n x 4] rows of the reference matrix
+    :param query_codes: letter codes of the query, one per row
+    :param substitution: dict storing cost of replacing one letter with another
+    :output: [n] scores
+    """
+    one_hot = (np.arange(ref_letter_probs.shape[1])[None, :] == np.asarray(query_codes)[:, None]).astype(np.int64)
+    return np.sum(ref_letter_probs * one_hot - mismatch_score * ref_letter_probs * (1 - one_hot), axis=1)
+
+
+@register_batch_form('sum_proba_score_correct0')
+def batch_sum_proba_score_correct0(ref_letter_probs, query_codes, mismatch_score=1, substitution=dict()):
+    """
+    batched sum_proba_score_correct0
+    :param ref_letter_probs: [n x 4] rows of the reference matrix
+    :param query_codes: letter codes of the query, one per row
+    :param substitution: dict storing cost of replacing one letter with another
+    :output: [n] scores
+    """
+    score = batch_sum_proba_score(ref_letter_probs, query_codes, mismatch_score, substitution)
+    best = np.argmax(ref_letter_probs, axis=1) == np.asarray(query_codes)
+    return np.where(best & (score < 0), 0., score)
+
+
+def batch_score(ref_letter_probs, query_codes, score_method, mismatch_score=1, substitution=dict()):
+    """
+    score rows of the reference against query letters
+    :param ref_letter_probs: [n x 4] rows of the reference matrix
+    :param query_codes: letter codes of the query, one per row
+    :param score_method: method of NT_BATCH_SCORE_ALGORITHM
+    :param mismatch_score: mismatch weight
+    :param substitution: dict storing cost of replacing one letter with another
+    :return: [n] scores
+    """
+    assert score_method in NT_BATCH_SCORE_ALGORITHM, 'no batched form for {0}'.format(score_method)
+    return NT_BATCH_SCORE_ALGORITHM[score_method](np.asarray(ref_letter_probs, dtype=np.float64),
+                                                  np.asarray(query_codes), mismatch_score, substitution)
+
+
+# kernels scoring a compact reference (see src/utils/compact_reference.py) without decoding its rows
+# ref_codes: most likely letter codes, ref_probs: their probabilities, query_codes: letter codes of the query
+# a compact kernel is registered under the name of its scalar form and must give the same values as the batched form
+# on the decoded rows, checked at registration
+NT_COMPACT_SCORE_ALGORITHM = Registry()
+
+
+def _check_compact_form(score_method, compact_fn):
+    """
+    compare a compact kernel with the batched form on the decoded rows, for all the confidence steps and letters
+    :param score_method: method of NT_BATCH_SCORE_ALGORITHM
+    :param compact_fn: compact kernel
+    """
+    assert score_method in NT_BATCH_SCORE_ALGORITHM, 'register the batched form of {0} first'.format(score_method)
+    # every (most likely letter, confidence) pair
+    reference = CompactReferenceMatrix(pack_codes(np.tile(np.arange(4), CONFIDENCE_SCALE + 1)),
+                                       np.repeat(np.arange(CONFIDENCE_SCALE + 1, dtype=np.uint8), 4))
+    positions = np.repeat(np.arange(len(reference)), 4)
+    query_codes = np.tile(np.arange(4), len(reference))
+    for mismatch_score in (1, 5):
+        expected = batch_score(reference[positions], query_codes, score_method, mismatch_score, dict())
+        scores = compact_fn(reference.codes(positions), reference.probabilities(positions), query_codes,
+                            mismatch_score, dict())
+        assert np.array_equal(scores, expected), 'compact and batched forms of {0} disagree'.format(score_method)
+
+
+def register_compact_form(score_method):
+    """
+    decorator registering the compact kernel of score_method, after checking it against the batched form
+    :param score_method: method of NT_BATCH_SCORE_ALGORITHM
+    """
+    def register_fn(fn):
+        _check_compact_form(score_method, fn)
+        return NT_COMPACT_SCORE_ALGORITHM.register(score_method)(fn)
+
+    return register_fn
+
+
+@register_compact_form('sum_proba_score')
+def compact_sum_proba_score(ref_codes, ref_probs, query_codes, mismatch_score=1, substitution=dict()):
+    """
+    vectorized sum_proba_score on the compact reference form, the terms of the 4 letters are summed in the same order
+    :param ref_codes: most likely letter codes of the reference positions
+    :param ref_probs: probabilities of the most likely letters
+    :param query_codes: letter codes of the query
+    :param substitution: dict storing cost of replacing one letter with another
+    :output: scores of the query letters at the reference positions
+    """
+    rest = (1 - ref_probs) / 3
+    score = 0.
+    for letter in range(4):
+        letter_prob = np.where(ref_codes == letter, ref_probs, rest)
+        one_hot = (query_codes == letter).astype(np.int64)
+        score = score + (letter_prob * one_hot - mismatch_score * letter_prob * (1 - one_hot))
+    return score
+
+
+@register_compact_form('sum_proba_score_correct0')
+def compact_sum_proba_score_correct0(ref_codes, ref_probs, query_codes, mismatch_score=1, substitution=dict()):
+    """
+    vectorized sum_proba_score_correct0 on the compact reference form
+    :param ref_codes: most likely letter codes of the reference positions
+    :param ref_probs: probabilities of the most likely letters
+    :param query_codes: letter codes of the query
+    :param substitution: dict storing cost of replacing one letter with another
+    :output: scores of the query letters at the reference positions
+    """
+    score = compact_sum_proba_score(ref_codes, ref_probs, query_codes, mismatch_score, substitution)
+
+    # argmax of the decoded row, the first other letter wins when p < 1/4
+    rest = (1 - ref_probs) / 3
+    argmax_codes = np.where(ref_probs > rest, ref_codes, np.where(ref_probs < rest, (ref_codes == 0).astype(int), 0))
+    return np.where((argmax_codes == query_codes) & (score < 0), 0., score)
+
+
+def compact_score(reference, positions, query_codes, score_method, mismatch_score=1, substitution=dict()):
+    """
+    score query letters against positions of a compact reference
+    :param reference: CompactReferenceMatrix
+    :param positions: reference positions (slice or array)
+    :param query_codes: letter codes of the query, same size as positions
+    :param score_method: method used to compute the score
+    :param mismatch_score: mismatch weight
+    :param substitution: dict storing cost of replacing one letter with another
+    :return: array of scores
+    """
+    assert score_method in NT_COMPACT_SCORE_ALGORITHM
+    return NT_COMPACT_SCORE_ALGORITHM[score_method](reference.codes(positions), reference.probabilities(positions),
+                                                    np.asarray(query_codes), mismatch_score, substitution)
+
+
+def reference_score(reference_matrix, positions, query_codes, score_method, mismatch_score=1, substitution=dict()):
+    """
+    score query letters against positions of the reference, compact references are scored on their codes and
+    probabilities when the method has a compact kernel, the other ones with the batched form on their rows
+    :param reference_matrix: [#NT x 4] reference matrix or CompactReferenceMatrix
+    :param positions: reference positions (slice or array)
+    :param query_codes: letter codes of the query, same size as positions
+    see batch_score for the other parameters
+    :return: array of scores
+    """
+    if isinstance(reference_matrix, CompactReferenceMatrix) and score_method in NT_COMPACT_SCORE_ALGORITHM:
+        return compact_score(reference_matrix, positions, query_codes, score_method, mismatch_score, substitution)
+    return batch_score(reference_matrix[positions], query_codes, score_method, mismatch_score, substitution)
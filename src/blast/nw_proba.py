@@ -6,8 +6,9 @@ affine gap penalty.
 # %% Useful imports
 
 import numpy as np
-from src.utils.utils import sequence_one_hot
-from src.blast.nt_scoring_function import NT_SCORE_ALGORITHM
+from src.utils.utils import sequence_one_hot, sequence_codes
+from src.blast.nt_scoring_function import NT_SCORE_ALGORITHM, NT_BATCH_SCORE_ALGORITHM
+from src.blast.score_table import compute_score_table
 
 
 # %% Methods to decide what to put in one matrix slot
@@ -114,11 +115,36 @@ def get_one_path(lastConsidered, draftPath, M_Previous, X_Previous,
 # %% Matrix computation
 
 
+def letter_scores(seq2, score_method, mismatch_score=5, substitution_dict=dict(), seq2_scores=None):
+    """
+    score of the 4 letters at every seq2 position
+    :param seq2_scores: rows of the score table of seq2 (see score_table.py), computed if None
+    :return: [n x 4] scores, None if score_method has no batched form and seq2_scores is not given
+    """
+    if seq2_scores is None:
+        if score_method not in NT_BATCH_SCORE_ALGORITHM:
+            return None
+        seq2_scores = compute_score_table(seq2, score_method, mismatch_score, substitution_dict)
+    return np.asarray(seq2_scores)
+
+
+def query_profile(seq1, seq2, score_method, mismatch_score=5, substitution_dict=dict(), seq2_scores=None):
+    """
+    substitution score of every (seq2 position, seq1 position) pair, the 4 letters are scored once per seq2 position
+    :param seq2_scores: rows of the score table of seq2 (see score_table.py), computed if None
+    :return: [n x p] scores, None if score_method has no batched form and seq2_scores is not given
+    """
+    scores = letter_scores(seq2, score_method, mismatch_score, substitution_dict, seq2_scores)
+    return None if scores is None else scores[:, sequence_codes(seq1)]
+
+
 def nw_affine_matrix_two(seq1, seq2, gap_create, gap_extend,
                          score_method, mismatch_score=5,
-                         substitution_dict=dict()):
+                         substitution_dict=dict(), seq2_scores=None):
     """
     Input: sequences to align and alignment info
+    seq2_scores: rows of the score table of seq2 (see score_table.py), if given the
+    substitution scores are read from it instead of calling score_method
     Output: best possible alignments and corresponding score
     """
     p = len(seq1)
@@ -131,6 +157,8 @@ def nw_affine_matrix_two(seq1, seq2, gap_create, gap_extend,
     Y_Previous = dict()
 
     seq1_onehot = sequence_one_hot(seq1)
+    # methods without a batched form are scored cell by cell
+    profile = query_profile(seq1, seq2, score_method, mismatch_score, substitution_dict, seq2_scores)
 
     # Initialize first matrix cells (first column for X, first line for Y)
     for i in range(n + 1):
@@ -158,11 +186,14 @@ def nw_affine_matrix_two(seq1, seq2, gap_create, gap_extend,
     for i in range(n):
         letter2_probas = seq2[i]
         for j in range(p):
-            letter1 = seq1_onehot[j]
-            substitution_score = NT_SCORE_ALGORITHM[score_method](letter2_probas,
-                                                                  letter1,
-                                                                  mismatch_score,
-                                                                  substitution_dict)
+            if profile is None:
+                letter1 = seq1_onehot[j]
+                substitution_score = NT_SCORE_ALGORITHM[score_method](letter2_probas,
+                                                                      letter1,
+                                                                      mismatch_score,
+                                                                      substitution_dict)
+            else:
+                substitution_score = profile[i, j]
             # M
             M_Previous[(i + 1, j + 1)] = []
             score, resM = get_max_M(M_Matrix, X_Matrix, Y_Matrix, i, j)
@@ -197,6 +228,145 @@ def nw_affine_matrix_two(seq1, seq2, gap_create, gap_extend,
             final_score, final_pos, final_mat)
 
 
+# %% Vectorized matrix computation
+
+# origins of a cell in the int8 traceback arrays, ties are broken in this order like get_max_M / get_max_X / get_max_Y
+ORIGIN_X = 0
+ORIGIN_Y = 1
+ORIGIN_M = 2
+ORIGIN_NAMES = 'XYM'
+
+
+def _max_origin(x_score, y_score, m_score):
+    """
+    vectorized get_max_*, the first of X, Y, M holding the max wins
+    :return: max scores, int8 origins
+    """
+    x_wins = x_score >= y_score
+    best = np.where(x_wins, x_score, y_score)
+    keep = best >= m_score
+    return np.where(keep, best, m_score), np.where(keep, ~x_wins, ORIGIN_M).astype(np.int8)
+
+
+def diagonal_column(i, d, band_width):
+    """
+    column of row i of the anti diagonal d in the matrices of nw_affine_matrix_vectorized, the rows of the band
+    (|2 * i - d| <= band_width) take the columns 1 to band_width + 1, columns 0 and band_width + 2 stay at -inf
+    """
+    return i - (d - band_width + 1) // 2 + 1
+
+
+def nw_affine_matrix_vectorized(seq2_scores, seq1_codes, gap_create, gap_extend, band_width=None):
+    """
+    same matrices, final score and traceback as nw_affine_matrix_two, computed one anti diagonal at a time (M depends
+    on the anti diagonal d - 2, X and Y on d - 1). Only the cells with |i - j| <= band_width are computed, the others
+    stay at -inf. The matrices are stored by anti diagonal, cell (i, j) at [i + j, diagonal_column(i, i + j, w)], so
+    each step only reads and writes contiguous slices and the memory is O((n + p) * w), the traceback is kept in int8
+    arrays
+    :param seq2_scores: [n x 4] score of each letter at each seq2 position, see letter_scores
+    :param seq1_codes: [p] letter codes of seq1
+    :param gap_create: cost for opening a gap
+    :param gap_extend: cost of a gap
+    :param band_width: band around the diagonal i == j, full matrices if None
+    :return: M, X, Y [n + p + 1 x w + 3] matrices and int8 origins stored by anti diagonal (w the band width, at most
+    max(n, p)), final score, final position, final matrix
+    """
+    n, p = len(seq2_scores), len(seq1_codes)
+    band_width = max(n, p) if band_width is None else min(band_width, max(n, p))
+    shape = (n + p + 1, band_width + 3)
+    M_Diag = np.full(shape, -np.inf)
+    X_Diag = np.full(shape, -np.inf)
+    Y_Diag = np.full(shape, -np.inf)
+    M_Origin = np.full(shape, -1, dtype=np.int8)
+    X_Origin = np.full(shape, -1, dtype=np.int8)
+    Y_Origin = np.full(shape, -1, dtype=np.int8)
+
+    def column(i, d):
+        return diagonal_column(i, d, band_width)
+
+    # first column for Y, first line for X, gaps are extended one by one as in nw_affine_matrix_two
+    M_Diag[0, column(0, 0)] = 0
+    for i in range(1, min(n, band_width) + 1):
+        cell, previous = (i, column(i, i)), (i - 1, column(i - 1, i - 1))
+        Y_Diag[cell] = gap_create + gap_extend if i == 1 else Y_Diag[previous] + gap_extend
+        Y_Origin[cell] = ORIGIN_M if i == 1 else ORIGIN_Y
+    for j in range(1, min(p, band_width) + 1):
+        cell, previous = (j, column(0, j)), (j - 1, column(0, j - 1))
+        X_Diag[cell] = gap_create + gap_extend if j == 1 else X_Diag[previous] + gap_extend
+        X_Origin[cell] = ORIGIN_M if j == 1 else ORIGIN_X
+
+    for d in range(2, n + p + 1):
+        # rows of the anti diagonal inside the matrix and inside the band
+        lo = max(1, d - p, (d - band_width + 1) // 2)
+        hi = min(n, d - 1, (d + band_width) // 2) + 1
+        if lo >= hi:
+            continue
+        rows = np.arange(lo, hi)
+        # cells (i, j) of this diagonal, (i - 1, j - 1) on d - 2, (i, j - 1) and (i - 1, j) on d - 1
+        cells = slice(column(lo, d), column(lo, d) + hi - lo)
+        diagonal = slice(column(lo - 1, d - 2), column(lo - 1, d - 2) + hi - lo)
+        left = slice(column(lo, d - 1), column(lo, d - 1) + hi - lo)
+        up = slice(left.start - 1, left.stop - 1)
+        score, M_Origin[d, cells] = _max_origin(X_Diag[d - 2, diagonal], Y_Diag[d - 2, diagonal],
+                                                M_Diag[d - 2, diagonal])
+        M_Diag[d, cells] = score + seq2_scores[rows - 1, seq1_codes[d - rows - 1]]
+        X_Diag[d, cells], X_Origin[d, cells] = _max_origin(X_Diag[d - 1, left] + gap_extend,
+                                                           Y_Diag[d - 1, left] + gap_create + gap_extend,
+                                                           M_Diag[d - 1, left] + gap_create + gap_extend)
+        Y_Diag[d, cells], Y_Origin[d, cells] = _max_origin(X_Diag[d - 1, up] + gap_create + gap_extend,
+                                                           Y_Diag[d - 1, up] + gap_extend,
+                                                           M_Diag[d - 1, up] + gap_create + gap_extend)
+
+    # best cell of the last column, the first one wins the ties, the cells outside of the band are at -inf
+    last_scores = np.full(n + 1, -np.inf)
+    last_origins = np.full(n + 1, ORIGIN_M, dtype=np.int8)
+    in_band = np.arange(max(0, p - band_width), min(n, p + band_width) + 1)
+    last = (in_band + p, column(in_band, in_band + p))
+    last_scores[in_band], last_origins[in_band] = _max_origin(X_Diag[last], Y_Diag[last], M_Diag[last])
+    k = int(np.argmax(last_scores))
+    return (M_Diag, X_Diag, Y_Diag, M_Origin, X_Origin, Y_Origin,
+            last_scores[k], (k, p), [ORIGIN_NAMES[last_origins[k]]])
+
+
+def path_band_width(final_pos, path):
+    """
+    :param final_pos: (i, j) end of the path
+    :param path: path from final_pos back to (0, 0), see get_path_vectorized
+    :return: max |i - j| of the cells of the path
+    """
+    offset = final_pos[0] - final_pos[1]
+    width = abs(offset)
+    for state in path:
+        # X steps back on seq1 (j - 1), Y on seq2 (i - 1), M on both
+        offset += (state == 'X') - (state == 'Y')
+        width = max(width, abs(offset))
+    return width
+
+
+def get_path_vectorized(final_pos, final_mat, M_Origin, X_Origin, Y_Origin):
+    """
+    the path get_all_paths finds, on the int8 traceback of nw_affine_matrix_vectorized (stored by anti diagonal)
+    :return: path from the final position back to (0, 0)
+    """
+    band_width = M_Origin.shape[1] - 3
+    (i, j), state = final_pos, ORIGIN_NAMES.index(final_mat)
+    path = []
+    while (i, j) != (0, 0):
+        path.append(ORIGIN_NAMES[state])
+        cell = i + j, diagonal_column(i, i + j, band_width)
+        if state == ORIGIN_X:
+            state = X_Origin[cell]
+            j -= 1
+        elif state == ORIGIN_Y:
+            state = Y_Origin[cell]
+            i -= 1
+        else:
+            state = M_Origin[cell]
+            i -= 1
+            j -= 1
+    return path
+
+
 # %% Method to get the sequence alignment corresponding to a given path
 
 
@@ -233,9 +403,53 @@ def from_path_to_als(path, seq1, seq2, offset):
 # %%
 
 
+def nw_affine_banded(seq2_scores, seq1_codes, gap_create, gap_extend, band_width):
+    """
+    banded alignment around the diagonal i == j, the band is doubled until the last column can be reached and the
+    best path does not touch the edge of the band (or the band covers the whole matrix), rows of seq2 the band
+    cannot reach are not computed
+    :param seq2_scores: [n x 4] score of each letter at each seq2 position, see letter_scores
+    :param seq1_codes: [p] letter codes of seq1
+    :param band_width: first band width, > 0
+    :return: final score, final position, final matrix, path
+    """
+    assert band_width > 0
+    n, p = len(seq2_scores), len(seq1_codes)
+    while True:
+        band_width = min(band_width, max(n, p))
+        M_Diag, X_Diag, Y_Diag, M_Origin, X_Origin, Y_Origin, final_score, final_pos, final_mat = \
+            nw_affine_matrix_vectorized(seq2_scores[:p + band_width], seq1_codes, gap_create, gap_extend, band_width)
+        whole = band_width == max(n, p)
+        # no cell of the last column in the band (seq2 shorter than seq1 by more than the band), nothing to trace back
+        if whole or final_score > -np.inf:
+            path = get_path_vectorized(final_pos, final_mat[0], M_Origin, X_Origin, Y_Origin)
+            if whole or path_band_width(final_pos, path) < band_width:
+                return final_score, final_pos, final_mat, path
+        band_width *= 2
+
+
 def nw_affine_two(seq1, seq2, gap_create, gap_extend, score_method,
                   substitution_dict=dict(), offset=0, all_paths=False,
-                  mismatch_score=5):
+                  mismatch_score=5, seq2_scores=None, band_width=None):
+    if offset == 0:
+        offset = dict()
+        offset[seq1] = list(range(len(seq1)))
+        offset["seq2"] = list(range(len(seq2)))
+
+    # the vectorized engine reads the letter scores of seq2, methods without a batched form go through the cell by
+    # cell version (which ignores band_width)
+    scores = letter_scores(seq2, score_method, mismatch_score, substitution_dict, seq2_scores)
+    if scores is not None:
+        seq1_codes = sequence_codes(seq1)
+        if band_width is None:
+            M_Diag, X_Diag, Y_Diag, M_Origin, X_Origin, Y_Origin, finalScore, finalPos, finalMat = \
+                nw_affine_matrix_vectorized(scores, seq1_codes, gap_create, gap_extend)
+            path = get_path_vectorized(finalPos, finalMat[0], M_Origin, X_Origin, Y_Origin)
+        else:
+            finalScore, finalPos, finalMat, path = nw_affine_banded(scores, seq1_codes, gap_create, gap_extend,
+                                                                    band_width)
+        return (from_path_to_als(path, seq1, seq2, offset), finalScore)
+
     M_Matrix, X_Matrix, Y_Matrix, M_Previous, X_Previous, Y_Previous, finalScore, finalPos, finalMat = nw_affine_matrix_two(
         seq1,
         seq2,
@@ -243,14 +457,9 @@ def nw_affine_two(seq1, seq2, gap_create, gap_extend, score_method,
         gap_extend,
         score_method,
         mismatch_score,
-        substitution_dict)
+        substitution_dict,
+        seq2_scores)
     paths = []
-    p = len(seq1)
-    n = len(seq2)
-    if offset == 0:
-        offset = dict()
-        offset[seq1] = list(range(len(seq1)))
-        offset["seq2"] = list(range(len(seq2)))
     for mat in finalMat:
         get_all_paths((finalPos, mat), paths, [], M_Previous, X_Previous,
                       Y_Previous)
@@ -0,0 +1,132 @@
+"""
+Score tables of the reference, the score of the 4 query letters at every reference position for one NT scoring config
+
+the NT scoring functions only depend on (reference row, query letter), so their values are computed once for the whole
+reference, block by block with the batched scoring forms (NT_BATCH_SCORE_ALGORITHM), and saved next to the reference
+file. The extension stages then read score_table[reference position, query letter code] instead of calling the scoring
+function for each cell.
+
+a table is identified by (score_method, mismatch_score, substitution), it is recomputed when the reference file changes
+"""
+
+import os
+import hashlib
+import numpy as np
+from src.blast.nt_scoring_function import NT_BATCH_SCORE_ALGORITHM, reference_score
+from src.utils.binary_format import ArrayFileWriter, open_array_file
+from src.utils.reference_io import load_reference_matrix
+from src.utils.compact_reference import CompactReferenceMatrix
+
+SCORE_TABLE_MAGIC = b'SCORETAB'
+SCORE_TABLE_FORMAT_VERSION = 1
+# number of reference positions scored at once
+DEFAULT_BLOCK_SIZE = 1 << 20
+
+
+def iter_score_table(reference_matrix, score_method, mismatch_score=1, substitution=dict(),
+                     block_size=DEFAULT_BLOCK_SIZE):
+    """
+    :param reference_matrix: [#NT x 4] reference matrix or CompactReferenceMatrix
+    :param score_method: method of NT_SCORE_ALGORITHM
+    :param mismatch_score: mismatch weight
+    :param substitution: dict storing cost of replacing one letter with another
+    :param block_size: number of reference positions scored at once
+    :return: generator of consecutive [block_size x 4] blocks of the score table
+    """
+    assert score_method in NT_BATCH_SCORE_ALGORITHM, 'no batched form for {0}'.format(score_method)
+    compact = isinstance(reference_matrix, CompactReferenceMatrix)
+    for start in range(0, len(reference_matrix), block_size):
+        block = slice(start, min(start + block_size, len(reference_matrix)))
+        # compact references are scored on their codes, without decoding the rows, dense blocks are read once
+        rows, positions = (reference_matrix, block) if compact else \
+            (np.asarray(reference_matrix[block], dtype=np.float64), slice(None))
+        scores = np.empty((block.stop - block.start, 4), dtype=np.float64)
+        for letter in range(4):
+            scores[:, letter] = reference_score(rows, positions, np.full(len(scores), letter), score_method,
+                                                mismatch_score, substitution)
+        yield scores
+
+
+def compute_score_table(reference_matrix, score_method, mismatch_score=1, substitution=dict(),
+                        block_size=DEFAULT_BLOCK_SIZE):
+    """
+    in memory score table
+    :return: [#NT x 4] float64 scores, see iter_score_table for the parameters
+    """
+    blocks = list(iter_score_table(reference_matrix, score_method, mismatch_score, substitution, block_size))
+    return np.concatenate(blocks) if len(blocks) > 0 else np.zeros((0, 4))
+
+
+def score_table_key(score_method, mismatch_score=1, substitution=dict()):
+    """
+    :return: short identifier of a scoring config
+    """
+    config = repr((score_method, mismatch_score, sorted(substitution.items())))
+    return hashlib.md5(config.encode('utf-8')).hexdigest()[:12]
+
+
+def score_table_path(reference_file, score_method, mismatch_score=1, substitution=dict()):
+    """
+    :param reference_file: reference matrix file
+    :return: path of the score table of the config, next to the reference file
+    """
+    return '{0}.{1}.{2}.scores'.format(os.path.splitext(reference_file)[0], score_method,
+                                       score_table_key(score_method, mismatch_score, substitution))
+
+
+def _reference_stamp(reference_file):
+    stat = os.stat(reference_file)
+    return {'reference_size': stat.st_size, 'reference_mtime': stat.st_mtime_ns}
+
+
+def write_score_table(reference_matrix, output_path, score_method, mismatch_score=1, substitution=dict(),
+                      block_size=DEFAULT_BLOCK_SIZE, meta=None):
+    """
+    compute the score table block by block into a file
+    :param reference_matrix: [#NT x 4] reference matrix or CompactReferenceMatrix
+    :param output_path: output path
+    :param meta: extra json serializable information stored in the header
+    see iter_score_table for the other parameters
+    """
+    meta = dict(meta if meta is not None else {}, score_method=score_method,
+                key=score_table_key(score_method, mismatch_score, substitution))
+    specs = [('scores', np.float64, (len(reference_matrix), 4))]
+    with ArrayFileWriter(output_path, SCORE_TABLE_MAGIC, SCORE_TABLE_FORMAT_VERSION, specs, meta) as writer:
+        for block in iter_score_table(reference_matrix, score_method, mismatch_score, substitution, block_size):
+            writer.write('scores', block)
+
+
+def open_score_table(path):
+    """
+    memory map a score table file
+    :param path: file path
+    :return: meta dict, read only [#NT x 4] scores
+    """
+    meta, arrays = open_array_file(path, SCORE_TABLE_MAGIC, SCORE_TABLE_FORMAT_VERSION)
+    return meta, arrays['scores']
+
+
+def load_score_table(reference, score_method, mismatch_score=1, substitution=dict(), reference_matrix=None):
+    """
+    score table of a reference, saved next to the reference file the first time it is needed then memory mapped
+    tables of in memory references are computed and kept in memory
+    :param reference: reference matrix file, or an already loaded matrix
+    :param score_method: method of NT_SCORE_ALGORITHM
+    :param mismatch_score: mismatch weight
+    :param substitution: dict storing cost of replacing one letter with another
+    :param reference_matrix: loaded matrix of reference, avoids loading it again
+    :return: [#NT x 4] scores
+    """
+    if reference_matrix is None:
+        reference_matrix = load_reference_matrix(reference)
+    if not isinstance(reference, str):
+        return compute_score_table(reference_matrix, score_method, mismatch_score, substitution)
+
+    path = score_table_path(reference, score_method, mismatch_score, substitution)
+    stamp = _reference_stamp(reference)
+    if os.path.exists(path):
+        meta, scores = open_score_table(path)
+        if all(meta.get(name) == value for name, value in stamp.items()) and len(scores) == len(reference_matrix):
+            return scores
+    write_score_table(reference_matrix, path, score_method, mismatch_score, substitution, meta=stamp)
+    return open_score_table(path)[1]
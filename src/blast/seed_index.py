@@ -0,0 +1,672 @@
+"""
+Seed index stored in CSR layout
+
+    codes       sorted unique integer codes of the indexed k-mers, 2 bits per letter, first letter in the highest bits
+    offsets     the positions of codes[i] are positions[offsets[i]:offsets[i + 1]]
+    positions   reference positions, sorted inside each code
+
+the index also answers dict style lookups with k-mer strings, so it can replace the dict of lists seed tables
+
+spaced seed indexes hold the k-mers of one or several patterns ('1' positions are part of the seed, '0' positions
+are ignored), the pattern id is stored above the k-mer bits of the codes
+
+minimizer indexes only hold the (w, k) minimizers of the reference: in each window of w consecutive k-mers the k-mer
+with the smallest hash, any match of at least w + k - 1 NT shares a minimizer with the reference
+
+k-mers occurring too often (repeats) can be capped: beyond max_occurrences positions a k-mer is either masked (no
+position kept) or sampled (max_occurrences evenly spaced positions kept), the capped codes are kept in masked_codes
+
+an index is stored in the binary container format (see src/utils/binary_format.py) with k and the seeding method in
+the header, the arrays are memory mapped and queried in place
+"""
+
+import numpy as np
+from src.utils.utils import sequence_codes
+from src.utils.compact_reference import CompactReferenceMatrix
+from src.utils.binary_format import write_array_file, open_array_file
+
+MAX_K = 31
+_INVALID_CODE = 4
+
+SEED_INDEX_MAGIC = b'SEEDINDX'
+SEED_INDEX_FORMAT_VERSION = 1
+
+# seed hits given by the matching stage to the extension stages
+SEED_HIT_DTYPE = np.dtype([('query_idx', np.int64), ('ref_idx', np.int64), ('score', np.float64),
+                           ('seed_length', np.int64)])
+
+
+def position_dtype(reference_length):
+    """
+    :param reference_length: number of NT of the reference
+    :return: smallest signed integer type holding all reference positions
+    """
+    return np.dtype(np.int32) if reference_length < 2 ** 31 else np.dtype(np.int64)
+
+
+def consensus_sequence(reference_matrix):
+    """
+    :param reference_matrix: reference probability matrix or CompactReferenceMatrix
+    :return: uint8 codes of the most likely letter of each position (same as np.argmax)
+    """
+    if isinstance(reference_matrix, CompactReferenceMatrix):
+        return reference_matrix.argmax_codes(slice(None))
+    return np.argmax(reference_matrix, axis=1).astype(np.uint8)
+
+
+def kmer_codes(letter_codes, k):
+    """
+    rolling 2 bits codes of all k-mers of a sequence
+    :param letter_codes: uint8 letter codes
+    :param k: k-mer size
+    :return: int64 array of size len(letter_codes) - k + 1, code of the k-mer starting at each position
+    """
+    assert 0 < k <= MAX_K
+    n = len(letter_codes) - k + 1
+    codes = np.zeros(max(n, 0), dtype=np.int64)
+    for i in range(k):
+        codes = (codes << 2) | letter_codes[i:i + n]
+    return codes
+
+
+def query_kmer_codes(query, k, characters="ACGT"):
+    """
+    :param query: query sequence of letters
+    :param k: k-mer size
+    :param characters: list of NT
+    :return: int64 codes of the k-mers starting at each query position, boolean mask of the k-mers made of
+    valid letters only
+    """
+    letters = sequence_codes(query, characters, invalid_code=_INVALID_CODE)
+    invalid = np.concatenate([[0], np.cumsum(letters == _INVALID_CODE)])
+    valid = (invalid[k:] - invalid[:-k]) == 0 if len(letters) >= k else np.zeros(0, dtype=bool)
+    return kmer_codes(np.where(letters == _INVALID_CODE, 0, letters).astype(np.uint8), k), valid
+
+
+def parse_seed_pattern(pattern):
+    """
+    :param pattern: spaced seed pattern, e.g. '111010010100110111'
+    :return: offsets of the '1' positions of the pattern
+    """
+    assert set(pattern) <= {'0', '1'} and pattern[0] == '1' and pattern[-1] == '1', \
+        'invalid seed pattern {0}'.format(pattern)
+    offsets = [idx for idx, x in enumerate(pattern) if x == '1']
+    assert len(offsets) <= MAX_K
+    return offsets
+
+
+def pattern_shift(patterns):
+    """
+    :param patterns: spaced seed patterns of one index
+    :return: bit position of the pattern id in the codes
+    """
+    shift = 2 * max(pattern.count('1') for pattern in patterns)
+    assert shift + (len(patterns) - 1).bit_length() <= 63, 'too many seed patterns for their weight'
+    return shift
+
+
+def spaced_kmer_codes(letter_codes, pattern):
+    """
+    codes of all spaced k-mers of a sequence
+    :param letter_codes: uint8 letter codes
+    :param pattern: spaced seed pattern
+    :return: int64 array of size len(letter_codes) - len(pattern) + 1, code of the spaced k-mer starting at each
+    position
+    """
+    n = len(letter_codes) - len(pattern) + 1
+    codes = np.zeros(max(n, 0), dtype=np.int64)
+    for offset in parse_seed_pattern(pattern):
+        codes = (codes << 2) | letter_codes[offset:offset + n]
+    return codes
+
+
+def query_spaced_kmer_codes(query, pattern, characters="ACGT"):
+    """
+    :param query: query sequence of letters
+    :param pattern: spaced seed pattern
+    :param characters: list of NT
+    :return: int64 codes of the spaced k-mers starting at each query position, boolean mask of the k-mers whose
+    '1' positions are valid letters
+    """
+    letters = sequence_codes(query, characters, invalid_code=_INVALID_CODE)
+    n = len(letters) - len(pattern) + 1
+    valid = np.ones(max(n, 0), dtype=bool)
+    for offset in parse_seed_pattern(pattern):
+        valid &= letters[offset:offset + n] != _INVALID_CODE
+    return spaced_kmer_codes(np.where(letters == _INVALID_CODE, 0, letters).astype(np.uint8), pattern), valid
+
+
+def kmer_hash(codes, k):
+    """
+    invertible integer hash of k-mer codes, spreads the minimizers of low complexity sequences
+    :param codes: int64 k-mer codes
+    :param k: k-mer size
+    :return: uint64 hashes in [0, 4 ** k)
+    """
+    mask = np.uint64((1 << (2 * k)) - 1)
+    key = np.asarray(codes).astype(np.uint64)
+    key = (~key + (key << np.uint64(21))) & mask
+    key = key ^ (key >> np.uint64(24))
+    key = (key + (key << np.uint64(3)) + (key << np.uint64(8))) & mask
+    key = key ^ (key >> np.uint64(14))
+    key = (key + (key << np.uint64(2)) + (key << np.uint64(4))) & mask
+    key = key ^ (key >> np.uint64(28))
+    key = (key + (key << np.uint64(31))) & mask
+    return key
+
+
+def minimizer_positions(codes, k, w, valid=None):
+    """
+    (w, k) minimizers of a sequence, ties are broken by the leftmost k-mer
+    :param codes: int64 codes of the k-mers starting at each position
+    :param k: k-mer size
+    :param w: number of consecutive k-mers per window
+    :param valid: boolean mask of the k-mers which can be selected, if None all of them
+    :return: sorted start positions of the minimizers, sequences shorter than a window give one minimizer
+    """
+    hashes = kmer_hash(codes, k)
+    if valid is not None:
+        hashes[~valid] = np.iinfo(np.uint64).max
+    if len(hashes) == 0:
+        return np.zeros(0, dtype=np.int64)
+    w = min(w, len(hashes))
+    windows = np.lib.stride_tricks.sliding_window_view(hashes, w)
+    positions = np.unique(np.arange(len(windows)) + np.argmin(windows, axis=1))
+    return positions if valid is None else positions[valid[positions]]
+
+
+def letter_masks(reference_block, threshold):
+    """
+    letters taken into account at each position: the most likely one plus the ones with proba >= threshold
+    :param reference_block: [n x 4] block of the reference matrix
+    :param threshold: min proba to take into account a nucleotide
+    :return: uint8 bit masks (bit i set when letter i is taken), uint8 codes of the most likely letters
+    """
+    reference_block = np.asarray(reference_block)
+    consensus = np.argmax(reference_block, axis=1).astype(np.uint8)
+    allowed = reference_block >= threshold
+    allowed[np.arange(len(reference_block)), consensus] = True
+    masks = np.sum(allowed << np.arange(reference_block.shape[1], dtype=np.uint8), axis=1).astype(np.uint8)
+    return masks, consensus
+
+
+# number of letters of each 4 bits mask, and the letters of the mask in increasing order
+_MASK_COUNTS = np.array([bin(mask).count('1') for mask in range(16)], dtype=np.int64)
+_MASK_LETTERS = np.array([[i for i in range(4) if mask >> i & 1] + [0] * (4 - bin(mask).count('1'))
+                          for mask in range(16)], dtype=np.int64)
+
+
+def window_kmer_counts(masks, k):
+    """
+    :param masks: letter bit masks, see letter_masks
+    :param k: k-mer size
+    :return: int64 number of possible k-mers of each window
+    """
+    counts = _MASK_COUNTS[masks]
+    n = max(len(masks) - k + 1, 0)
+    sizes = np.ones(n, dtype=np.int64)
+    for i in range(k):
+        sizes *= counts[i:i + n]
+    return sizes
+
+
+def expand_kmer_codes(masks, window_starts, k):
+    """
+    enumerate all k-mers of several windows, the frontier of partial k-mers of all windows is extended one letter at a
+    time as integer codes
+    :param masks: letter bit masks, see letter_masks
+    :param window_starts: start of the windows in masks
+    :param k: k-mer size
+    :return: int64 k-mer codes, start of the window of each code
+    """
+    assert 0 < k <= MAX_K
+    starts = np.asarray(window_starts, dtype=np.int64)
+    codes = np.zeros(len(starts), dtype=np.int64)
+    for i in range(k):
+        window_masks = masks[starts + i]
+        counts = _MASK_COUNTS[window_masks]
+        ranks = np.arange(np.sum(counts)) - np.repeat(np.cumsum(counts) - counts, counts)
+        letters = _MASK_LETTERS[np.repeat(window_masks, counts), ranks]
+        codes = (np.repeat(codes, counts) << 2) | letters
+        starts = np.repeat(starts, counts)
+    return codes, starts
+
+
+def encode_kmer(seed, characters="ACGT"):
+    """
+    :param seed: k-mer string
+    :param characters: list of NT
+    :return: integer code, -1 if the k-mer contains other letters
+    """
+    code = 0
+    for letter in seed:
+        idx = characters.find(letter)
+        if idx < 0:
+            return -1
+        code = (code << 2) | idx
+    return code
+
+
+def decode_kmer(code, k, characters="ACGT"):
+    """
+    :param code: integer code
+    :param k: k-mer size
+    :param characters: list of NT
+    :return: k-mer string
+    """
+    return ''.join(characters[(int(code) >> (2 * (k - 1 - i))) & 3] for i in range(k))
+
+
+class SeedIndex(object):
+    """
+    seed table in CSR layout, see module docstring
+    """
+
+    def __init__(self, k, codes, offsets, positions, patterns=None, masked_codes=None, window=None):
+        """
+        :param k: seed size
+        :param codes: sorted unique int64 k-mer codes
+        :param offsets: int64 array of size len(codes) + 1
+        :param positions: reference positions grouped by code
+        :param patterns: spaced seed patterns, None for contiguous k-mers
+        :param masked_codes: sorted codes whose positions were capped, see cap_occurrences
+        :param window: minimizer window size w of minimizer indexes, None when every position is indexed
+        """
+        assert len(offsets) == len(codes) + 1
+        self.k = k
+        self.patterns = None if patterns is None else list(patterns)
+        self.codes = codes
+        self.offsets = offsets
+        self.positions = positions
+        self.masked_codes = np.zeros(0, dtype=np.int64) if masked_codes is None else masked_codes
+        self.window = window
+
+    @classmethod
+    def from_pairs(cls, k, codes, positions, dtype=None, patterns=None, window=None):
+        """
+        build the index out of (k-mer code, reference position) pairs
+        :param k: seed size
+        :param codes: int64 k-mer codes
+        :param positions: reference positions of the k-mers
+        :param dtype: stored position type, if None keep the integer type of positions
+        :param patterns: spaced seed patterns, None for contiguous k-mers
+        :param window: minimizer window size of minimizer indexes
+        :return: SeedIndex
+        """
+        codes = np.asarray(codes, dtype=np.int64)
+        positions = np.asarray(positions)
+        order = np.lexsort((positions, codes))
+        codes = codes[order]
+        if dtype is None:
+            dtype = positions.dtype if positions.dtype.kind == 'i' else np.int64
+        positions = positions[order].astype(dtype)
+
+        starts = np.flatnonzero(np.concatenate([[True], codes[1:] != codes[:-1]])) if len(codes) > 0 \
+            else np.zeros(0, dtype=np.int64)
+        offsets = np.concatenate([starts, [len(codes)]]).astype(np.int64)
+        return cls(k, codes[starts], offsets, positions, patterns, window=window)
+
+    @classmethod
+    def from_dict(cls, k, table, characters="ACGT", dtype=None):
+        """
+        convert a dict of lists seed table
+        :param k: seed size
+        :param table: dict k-mer string -> list of reference positions
+        :param characters: list of NT
+        :param dtype: stored position type
+        :return: SeedIndex
+        """
+        codes = [encode_kmer(seed, characters) for seed, positions in table.items() for _ in positions]
+        positions = [position for seed_positions in table.values() for position in seed_positions]
+        return cls.from_pairs(k, np.array(codes, dtype=np.int64), np.array(positions, dtype=np.int64), dtype)
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def size(self):
+        """
+        :return: total number of indexed positions
+        """
+        return len(self.positions)
+
+    def counts(self):
+        """
+        :return: number of positions of each code
+        """
+        return np.diff(self.offsets)
+
+    def cap_occurrences(self, max_occurrences, mode='mask'):
+        """
+        limit the number of positions of each k-mer
+        :param max_occurrences: max number of positions per k-mer
+        :param mode: 'mask' drops all positions of the k-mers above the cap, 'sample' keeps max_occurrences evenly
+        spaced positions of them
+        :return: capped SeedIndex, the capped codes are added to masked_codes
+        """
+        assert mode in ('mask', 'sample') and max_occurrences > 0
+        counts = self.counts()
+        over = counts > max_occurrences
+        kept_counts = np.where(over, 0 if mode == 'mask' else max_occurrences, counts)
+
+        # rank of the kept positions inside the run of their code, evenly spaced for sampled codes
+        ranks = np.arange(np.sum(kept_counts)) - np.repeat(np.cumsum(kept_counts) - kept_counts, kept_counts)
+        ranks = ranks * np.repeat(counts, kept_counts) // np.repeat(np.maximum(kept_counts, 1), kept_counts)
+        positions = self.positions[np.repeat(self.offsets[:-1], kept_counts) + ranks]
+
+        keep = kept_counts > 0
+        offsets = np.concatenate([[0], np.cumsum(kept_counts[keep])]).astype(np.int64)
+        masked_codes = np.union1d(self.masked_codes, self.codes[over]).astype(np.int64)
+        return SeedIndex(self.k, self.codes[keep], offsets, positions, self.patterns, masked_codes, self.window)
+
+    def insert(self, codes, positions, dtype=None):
+        """
+        add (k-mer code, reference position) pairs to the index, the pairs already indexed are skipped, the new pairs
+        are placed in the sorted arrays with searchsorted instead of sorting the whole index again
+        :param codes: int64 k-mer codes
+        :param positions: reference positions of the k-mers
+        :param dtype: stored position type, if None keep the type of the index
+        :return: SeedIndex
+        """
+        codes = np.asarray(codes, dtype=np.int64)
+        positions = np.asarray(positions, dtype=np.int64)
+        order = np.lexsort((positions, codes))
+        codes, positions = codes[order], positions[order]
+        if len(codes) > 0:
+            keep = np.concatenate([[True], (codes[1:] != codes[:-1]) | (positions[1:] != positions[:-1])])
+            codes, positions = codes[keep], positions[keep]
+
+        idx = np.searchsorted(self.codes, codes)
+        found = idx < len(self.codes)
+        found[found] = self.codes[idx[found]] == codes[found]
+        # a new position goes at the end of the run of its code when it is after the last one (appended positions),
+        # the other ones are searched in the run
+        at = np.where(found, self.offsets[np.minimum(idx + 1, len(self.codes))], self.offsets[idx])
+        last = self.positions[np.maximum(at - 1, 0)] if len(self.positions) > 0 else np.zeros(len(at), dtype=np.int64)
+        inside = np.flatnonzero(found & (positions <= last))
+        keep = np.ones(len(codes), dtype=bool)
+        for i in inside:
+            run = self.positions[self.offsets[idx[i]]:self.offsets[idx[i] + 1]]
+            j = np.searchsorted(run, positions[i])
+            at[i] = self.offsets[idx[i]] + j
+            keep[i] = j == len(run) or run[j] != positions[i]
+        codes, positions, idx, found, at = codes[keep], positions[keep], idx[keep], found[keep], at[keep]
+
+        dtype = self.positions.dtype if dtype is None else dtype
+        new_positions = np.insert(self.positions.astype(dtype), at, positions.astype(dtype))
+        new_codes = np.unique(codes[~found])
+        merged_codes = np.insert(np.asarray(self.codes, dtype=np.int64), np.searchsorted(self.codes, new_codes),
+                                 new_codes)
+        counts = np.zeros(len(merged_codes), dtype=np.int64)
+        counts[np.searchsorted(merged_codes, self.codes)] = self.counts()
+        counts += np.bincount(np.searchsorted(merged_codes, codes), minlength=len(merged_codes))
+        offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        return SeedIndex(self.k, merged_codes, offsets, new_positions, self.patterns, self.masked_codes, self.window)
+
+    def is_masked(self, codes):
+        """
+        :param codes: k-mer codes
+        :return: boolean array, True for the codes capped by cap_occurrences
+        """
+        return np.isin(codes, self.masked_codes)
+
+    def lookup(self, code):
+        """
+        :param code: k-mer code
+        :return: view on the reference positions of the k-mer, empty if it is not indexed
+        """
+        idx = np.searchsorted(self.codes, code)
+        if idx < len(self.codes) and self.codes[idx] == code:
+            return self.positions[self.offsets[idx]:self.offsets[idx + 1]]
+        return self.positions[:0]
+
+    def join(self, codes):
+        """
+        merge join of sorted k-mer codes with the sorted codes of the index, codes and positions are read in
+        increasing order so each page of a memory mapped index is touched once
+        :param codes: sorted int64 k-mer codes
+        :return: start in positions and number of positions of each code, 0 positions for the codes not indexed
+        """
+        if len(self.codes) == 0:
+            return np.zeros(len(codes), dtype=np.int64), np.zeros(len(codes), dtype=np.int64)
+        # searchsorted narrows each search with the previous result when the keys are sorted
+        idx = np.minimum(np.searchsorted(self.codes, codes), len(self.codes) - 1)
+        found = self.codes[idx] == codes
+        starts = self.offsets[idx]
+        return starts, np.where(found, self.offsets[idx + 1] - starts, 0)
+
+    def search(self, codes):
+        """
+        batched lookup of several k-mers, the distinct codes are joined once with the index
+        :param codes: int64 k-mer codes, e.g. the k-mers of a batch of queries
+        :return: index in codes of each match, matched reference positions (grouped by code, in order of codes)
+        """
+        codes = np.asarray(codes, dtype=np.int64)
+        if len(self.codes) == 0:
+            return np.zeros(0, dtype=np.int64), self.positions[:0]
+        unique_codes, inverse = np.unique(codes, return_inverse=True)
+        starts, counts = self.join(unique_codes)
+        # positions of the distinct codes, read in increasing order, then copied to each occurrence of the codes
+        unique_positions = self.positions[concat_ranges(starts, counts)]
+        code_counts = counts[inverse]
+        code_idx = np.repeat(np.arange(len(codes)), code_counts)
+        return code_idx, unique_positions[concat_ranges((np.cumsum(counts) - counts)[inverse], code_counts)]
+
+    def get(self, seed, default=None):
+        """
+        dict style lookup, contiguous k-mers only
+        :param seed: k-mer string
+        :param default: returned value if the k-mer is not indexed
+        :return: reference positions of the k-mer
+        """
+        assert self.patterns is None
+        code = encode_kmer(seed) if len(seed) == self.k else -1
+        matches = self.lookup(code) if code >= 0 else self.positions[:0]
+        return matches if len(matches) > 0 else default
+
+    def __contains__(self, seed):
+        return self.get(seed) is not None
+
+    def __getitem__(self, seed):
+        matches = self.get(seed)
+        if matches is None:
+            raise KeyError(seed)
+        return matches
+
+    def to_dict(self, characters="ACGT"):
+        """
+        :param characters: list of NT
+        :return: dict of lists seed table, same format as the legacy seeding methods
+        """
+        assert self.patterns is None
+        return {
+            decode_kmer(code, self.k, characters): self.positions[self.offsets[idx]:self.offsets[idx + 1]].tolist()
+            for idx, code in enumerate(self.codes)
+        }
+
+
+def concat_ranges(starts, counts):
+    """
+    :param starts: start of each range
+    :param counts: length of each range
+    :return: int64 concatenation of the ranges starts[i] .. starts[i] + counts[i] - 1
+    """
+    counts = np.asarray(counts, dtype=np.int64)
+    run_starts = np.cumsum(counts) - counts
+    return np.repeat(starts, counts) + np.arange(np.sum(counts), dtype=np.int64) - np.repeat(run_starts, counts)
+
+
+def make_seed_hits(query_idx, ref_idx, seed_length, score=0.):
+    """
+    :param query_idx: query positions of the hits
+    :param ref_idx: reference positions of the hits
+    :param seed_length: seed length of each hit, or one length for all of them
+    :param score: seed scores
+    :return: structured array of SEED_HIT_DTYPE
+    """
+    hits = np.zeros(len(query_idx), dtype=SEED_HIT_DTYPE)
+    hits['query_idx'] = query_idx
+    hits['ref_idx'] = ref_idx
+    hits['score'] = score
+    hits['seed_length'] = seed_length
+    return hits
+
+
+def seed_hits_to_matches(hits):
+    """
+    :param hits: structured array of SEED_HIT_DTYPE
+    :return: list of {'seed_matching_result': {...}} dicts, the format the extension stages fill in
+    """
+    return [
+        {
+            'seed_matching_result': {
+                'query_idx': query_idx,
+                'ref_idx': ref_idx,
+                'score': score,
+                'seed_length': seed_length
+            }
+        }
+        for query_idx, ref_idx, score, seed_length in zip(hits['query_idx'].tolist(), hits['ref_idx'].tolist(),
+                                                          hits['score'].tolist(), hits['seed_length'].tolist())
+    ]
+
+
+def seed_hit_columns(matches, k):
+    """
+    :param matches: structured array of SEED_HIT_DTYPE, or list of {'seed_matching_result': {...}} dicts
+    :param k: seed length of the dicts without seed_length
+    :return: query_idx, ref_idx and seed_length int64 arrays
+    """
+    if isinstance(matches, np.ndarray):
+        return (matches['query_idx'].astype(np.int64), matches['ref_idx'].astype(np.int64),
+                matches['seed_length'].astype(np.int64))
+    results = [match['seed_matching_result'] for match in matches]
+    return (np.array([result['query_idx'] for result in results], dtype=np.int64),
+            np.array([result['ref_idx'] for result in results], dtype=np.int64),
+            np.array([result.get('seed_length', k) for result in results], dtype=np.int64))
+
+
+def seed_hit_match(matches, idx):
+    """
+    :param matches: structured array of SEED_HIT_DTYPE, or list of {'seed_matching_result': {...}} dicts
+    :param idx: hit index
+    :return: {'seed_matching_result': {...}} dict of the hit, the dict itself for a list of dicts
+    """
+    if not isinstance(matches, np.ndarray):
+        return matches[idx]
+    query_idx, ref_idx, score, seed_length = matches[idx].item()
+    return {
+        'seed_matching_result': {
+            'query_idx': query_idx,
+            'ref_idx': ref_idx,
+            'score': score,
+            'seed_length': seed_length
+        }
+    }
+
+
+def spaced_seed_hits(index, query, characters="ACGT"):
+    """
+    seed hits of a query in a spaced seed index, a (query position, reference position) pair hit by several patterns
+    is only reported for the first one
+    :param index: SeedIndex with patterns
+    :param query: query sequence of letters
+    :param characters: list of NT
+    :return: query positions, reference positions and seed lengths (pattern spans) of the hits
+    """
+    shift = pattern_shift(index.patterns)
+    hits = []
+    for pattern_id, pattern in enumerate(index.patterns):
+        codes, valid = query_spaced_kmer_codes(query, pattern, characters)
+        query_idx = np.flatnonzero(valid)
+        match_idx, ref_idx = index.search(codes[query_idx] | (pattern_id << shift))
+        hits.append((query_idx[match_idx], ref_idx.astype(np.int64), np.full(len(ref_idx), len(pattern))))
+
+    query_idx, ref_idx, seed_length = [np.concatenate(x) for x in zip(*hits)]
+    _, first = np.unique(np.stack([query_idx, ref_idx], axis=1), axis=0, return_index=True)
+    return query_idx[first], ref_idx[first], seed_length[first]
+
+
+def minimizer_hits(index, query, characters="ACGT"):
+    """
+    seed hits of the minimizers of a query in a minimizer index
+    :param index: SeedIndex with window
+    :param query: query sequence of letters
+    :param characters: list of NT
+    :return: query positions, reference positions of the hits
+    """
+    codes, valid = query_kmer_codes(query, index.k, characters)
+    query_idx = minimizer_positions(codes, index.k, index.window, valid)
+    match_idx, ref_idx = index.search(codes[query_idx])
+    return query_idx[match_idx], ref_idx
+
+
+def merge_seed_indexes(indexes, dtype=None):
+    """
+    merge several indexes of the same seed size into one
+    :param indexes: list of SeedIndex
+    :param dtype: stored position type, if None use the widest type of the indexes
+    :return: SeedIndex
+    """
+    assert len(indexes) > 0
+    assert all(index.k == indexes[0].k and index.patterns == indexes[0].patterns and index.window == indexes[0].window
+               for index in indexes)
+    if dtype is None:
+        dtype = np.result_type(*[index.positions.dtype for index in indexes])
+    codes = np.concatenate([np.repeat(index.codes, index.counts()) for index in indexes])
+    positions = np.concatenate([index.positions.astype(np.int64) for index in indexes])
+    index = SeedIndex.from_pairs(indexes[0].k, codes, positions, dtype, indexes[0].patterns, indexes[0].window)
+    index.masked_codes = np.unique(np.concatenate([x.masked_codes for x in indexes])).astype(np.int64)
+    return index
+
+
+def occurrence_stats(index, max_occurrences=None):
+    """
+    statistics of the number of positions per k-mer
+    :param index: SeedIndex
+    :param max_occurrences: occurrence cap, if given also count the k-mers and positions above it
+    :return: json serializable dict
+    """
+    counts = index.counts()
+    stats = {
+        'seeds': len(index),
+        'positions': index.size,
+        'max_occurrences': int(counts.max()) if len(counts) > 0 else 0,
+        'mean_occurrences': float(counts.mean()) if len(counts) > 0 else 0.,
+        'p99_occurrences': float(np.percentile(counts, 99)) if len(counts) > 0 else 0.,
+        # expected number of hits of a reference k-mer, what a query k-mer costs on average
+        'mean_hits_per_position': float(np.sum(counts.astype(np.float64) ** 2) / max(index.size, 1))
+    }
+    if max_occurrences is not None:
+        over = counts > max_occurrences
+        stats['seeds_over_cap'] = int(np.sum(over))
+        stats['positions_over_cap'] = int(np.sum(counts[over]))
+    return stats
+
+
+def save_seed_index(index, output_path, method, meta=None):
+    """
+    :param index: SeedIndex
+    :param output_path: output path
+    :param method: seeding method used to build the index
+    :param meta: extra json serializable information stored in the header
+    """
+    meta = dict(meta if meta is not None else {}, k=index.k, method=method)
+    if index.patterns is not None:
+        meta['patterns'] = index.patterns
+    if index.window is not None:
+        meta['window'] = index.window
+    arrays = {'codes': index.codes, 'offsets': index.offsets, 'positions': index.positions,
+              'masked_codes': index.masked_codes}
+    write_array_file(output_path, SEED_INDEX_MAGIC, SEED_INDEX_FORMAT_VERSION, arrays, meta)
+
+
+def open_seed_index(path):
+    """
+    memory map a seed index file
+    :param path: file path
+    :return: meta dict, SeedIndex
+    """
+    meta, arrays = open_array_file(path, SEED_INDEX_MAGIC, SEED_INDEX_FORMAT_VERSION)
+    return meta, SeedIndex(meta['k'], arrays['codes'], arrays['offsets'], arrays['positions'], meta.get('patterns'),
+                           arrays.get('masked_codes'), meta.get('window'))
@@ -0,0 +1,180 @@
+"""
+Suffix array of the most likely sequence, seeds are super maximal exact matches (SMEMs) of variable length
+
+a SMEM is an exact match between the query and the reference which is not contained in a longer one, a long exact
+run of the query gives a single seed instead of one seed per overlapping k-mer
+
+records of the reference are separated by a letter which never matches, so matches never cross a record boundary
+"""
+
+import bisect
+import numpy as np
+from src.utils.utils import sequence_codes
+from src.utils.binary_format import write_array_file, open_array_file
+
+SUFFIX_ARRAY_MAGIC = b'SUFARRAY'
+SUFFIX_ARRAY_FORMAT_VERSION = 1
+_SEPARATOR = 4
+_INVALID_CODE = 5
+
+
+def build_suffix_array(text):
+    """
+    suffix array by prefix doubling, the suffixes are sorted by their first 2^i letters at step i
+    :param text: uint8 letter codes
+    :return: int64 start positions of the suffixes of text in lexicographic order
+    """
+    n = len(text)
+    rank = np.asarray(text, dtype=np.int64)
+    if n == 0:
+        return np.zeros(0, dtype=np.int64)
+    step = 1
+    while True:
+        next_rank = np.full(n, -1, dtype=np.int64)
+        next_rank[:n - step] = rank[step:]
+        order = np.lexsort((next_rank, rank))
+        sorted_rank = rank[order]
+        sorted_next = next_rank[order]
+        new_group = np.concatenate([[True], (sorted_rank[1:] != sorted_rank[:-1]) |
+                                    (sorted_next[1:] != sorted_next[:-1])])
+        rank = np.empty(n, dtype=np.int64)
+        rank[order] = np.cumsum(new_group) - 1
+        if rank[order[-1]] == n - 1 or step >= n:
+            return order
+        step *= 2
+
+
+class SuffixArrayIndex(object):
+    """
+    suffix array of the most likely sequence of the reference
+    """
+
+    def __init__(self, k, text, suffix_array, separators):
+        """
+        :param k: min SMEM length
+        :param text: uint8 letter codes of the records, separated by _SEPARATOR
+        :param suffix_array: suffix array of text
+        :param separators: sorted positions of the separators in text
+        """
+        self.k = k
+        self.text = text
+        self.suffix_array = suffix_array
+        self.separators = separators
+
+    @classmethod
+    def from_sequence(cls, k, letter_codes, contig_index=None):
+        """
+        :param k: min SMEM length
+        :param letter_codes: uint8 codes of the most likely sequence
+        :param contig_index: ContigIndex of the reference, a separator is inserted between records
+        :return: SuffixArrayIndex
+        """
+        letter_codes = np.asarray(letter_codes, dtype=np.uint8)
+        if contig_index is None or len(contig_index) == 1:
+            text = letter_codes
+            separators = np.zeros(0, dtype=np.int64)
+        else:
+            ends = contig_index.offsets[1:-1]
+            text = np.insert(letter_codes, ends, _SEPARATOR)
+            separators = ends + np.arange(len(ends))
+        return cls(k, text, build_suffix_array(text), separators)
+
+    @property
+    def text_buffer(self):
+        """
+        :return: memoryview over text, slices of it are compared with the patterns without copying the whole text
+        """
+        return memoryview(np.ascontiguousarray(self.text))
+
+    def reference_positions(self, text_positions):
+        """
+        :param text_positions: positions in text
+        :return: positions in the reference
+        """
+        text_positions = np.asarray(text_positions, dtype=np.int64)
+        return text_positions - np.searchsorted(self.separators, text_positions)
+
+    def _suffix_range(self, pattern):
+        """
+        :param pattern: bytes
+        :return: range of the suffix array of the suffixes starting with pattern
+        """
+        text = self.text_buffer
+        length = len(pattern)
+
+        def key(position):
+            return text[position:position + length].tobytes()
+
+        return bisect.bisect_left(self.suffix_array, pattern, key=key), \
+            bisect.bisect_right(self.suffix_array, pattern, key=key)
+
+    def _longest_match(self, query):
+        """
+        :param query: bytes
+        :return: length of the longest prefix of query occurring in the reference
+        """
+        text = self.text_buffer
+        idx = bisect.bisect_left(self.suffix_array, query,
+                                 key=lambda position: text[position:position + len(query)].tobytes())
+        best = 0
+        # the suffixes sharing the longest prefix with query are next to its insertion point
+        for neighbour in (idx - 1, idx):
+            if 0 <= neighbour < len(self.suffix_array):
+                start = int(self.suffix_array[neighbour])
+                suffix = text[start:start + len(query)].tobytes()
+                length = 0
+                while length < len(suffix) and suffix[length] == query[length]:
+                    length += 1
+                best = max(best, length)
+        return best
+
+    def smems(self, query, min_length=None, max_occurrences=None, characters="ACGT"):
+        """
+        super maximal exact matches of a query, the match starting at i is maximal when it ends after the match
+        starting at i - 1 (match ends never decrease along the query)
+        :param query: query sequence of letters
+        :param min_length: min SMEM length, if None use k
+        :param max_occurrences: max number of reference positions reported per SMEM, None for all
+        :param characters: list of NT
+        :return: list of (query position, length, reference positions)
+        """
+        min_length = self.k if min_length is None else min_length
+        query_bytes = sequence_codes(query, characters, invalid_code=_INVALID_CODE).tobytes()
+
+        results = []
+        previous_end = 0
+        for idx in range(len(query_bytes)):
+            if previous_end >= len(query_bytes):
+                break
+            length = self._longest_match(query_bytes[idx:])
+            end = idx + length
+            if end > previous_end and length >= min_length:
+                left, right = self._suffix_range(query_bytes[idx:end])
+                if max_occurrences is not None:
+                    right = min(right, left + max_occurrences)
+                positions = np.sort(self.reference_positions(self.suffix_array[left:right]))
+                results.append((idx, length, positions))
+            previous_end = max(previous_end, end)
+        return results
+
+
+def save_suffix_array(index, output_path, method, meta=None):
+    """
+    :param index: SuffixArrayIndex
+    :param output_path: output path
+    :param method: seeding method used to build the index
+    :param meta: extra json serializable information stored in the header
+    """
+    meta = dict(meta if meta is not None else {}, k=index.k, method=method)
+    arrays = {'text': index.text, 'suffix_array': index.suffix_array, 'separators': index.separators}
+    write_array_file(output_path, SUFFIX_ARRAY_MAGIC, SUFFIX_ARRAY_FORMAT_VERSION, arrays, meta)
+
+
+def open_suffix_array(path):
+    """
+    memory map a suffix array file
+    :param path: file path
+    :return: meta dict, SuffixArrayIndex
+    """
+    meta, arrays = open_array_file(path, SUFFIX_ARRAY_MAGIC, SUFFIX_ARRAY_FORMAT_VERSION)
+    return meta, SuffixArrayIndex(meta['k'], arrays['text'], arrays['suffix_array'], arrays['separators'])
@@ -1,35 +1,70 @@
-import pickle
-from src.utils.utils import sequence_one_hot
-from src.blast.nt_scoring_function import NT_SCORE_ALGORITHM
+import numpy as np
+from src.utils.utils import sequence_one_hot, sequence_codes
+from src.blast.nt_scoring_function import NT_SCORE_ALGORITHM, reference_score
+from src.utils.reference_io import load_reference_matrix
+from src.blast.seed_index import seed_hit_columns, seed_hit_match
 
+# number of extension steps scored at once for all the extensions still running, see batch_ungapped_extension
+DEFAULT_STEP_CHUNK = 32
 
-def ungapped_extension(query, matches_dict, reference_matrix_file, k, delta,
-                       score_method, mismatch_score=1, substitution=dict()):
+
+def ungapped_extension(query, matches_dict, reference_matrix, k, delta,
+                       score_method, mismatch_score=1, substitution=dict(), contig_index=None, skip_covered=False,
+                       score_table=None, score_seed=False):
     """
     compute ungapped extension
     generates ungapped extended matches and corresponding HSP scores
     :param query: query sequence of letters (ACGT)
-    :param reference_matrix_file: reference matrix file
-    :matches: matches between query seq and seeds, see consensus_seq_match for format
-    :param k: seed size
+    :param reference_matrix: reference matrix or reference matrix file
+    :matches: matches between query seq and seeds, structured array of seed hits (see consensus_seq_hits) or list of
+    dicts (see consensus_seq_match)
+    :param k: seed size, spaced seed matches give their own seed_length
     :param delta: max allowed score drop before extension is stopped, positive value
     :param score_method: method used to compute extension score
     :param substitution_dict: stores the cost of replacing one letter by another
+    :param contig_index: ContigIndex of the reference, extensions stop at the record boundaries
+    :param skip_covered: skip the seeds lying inside the span of an extension already made on their diagonal, each
+    HSP is then only reported once
+    :param score_table: [#NT x 4] score table of (score_method, mismatch_score, substitution), see score_table.py, if
+    None the scores are computed by score_method
+    :param score_seed: add the score of the seed span to the HSP score (variable length seeds, see smem_matching), it
+    is also reported as seed_span_score
     :return: ungapped_extensions dict (positions and scores)
     """
     assert score_method in NT_SCORE_ALGORITHM
 
     query_one_hot = sequence_one_hot(query)
-    reference_matrix = pickle.load(open(reference_matrix_file, 'rb'))
+    reference_matrix = load_reference_matrix(reference_matrix)
     ref_length, _ = reference_matrix.shape
+    if score_table is None:
+        def nt_score(ref_pos, query_pos):
+            return NT_SCORE_ALGORITHM[score_method](reference_matrix[ref_pos], query_one_hot[query_pos],
+                                                    mismatch_score, substitution)
+    else:
+        query_codes = sequence_codes(query)
+
+        def nt_score(ref_pos, query_pos):
+            return score_table[ref_pos, query_codes[query_pos]]
 
     ungapped_extensions = []
+    hits_query_idx, hits_ref_idx, hits_seed_length = (column.tolist() for column in seed_hit_columns(matches_dict, k))
+    # diagonal (ref_idx - query_idx) -> reference spans of the extensions made on it
+    covered = {}
 
-    for match in matches_dict:
-        query_idx = match['seed_matching_result']['query_idx']
-        match_idx = match['seed_matching_result']['ref_idx']
+    for idx in range(len(hits_query_idx)):
+        query_idx = hits_query_idx[idx]
+        match_idx = hits_ref_idx[idx]
+        seed_length = hits_seed_length[idx]
+        diagonal = match_idx - query_idx
+        if skip_covered and any(left <= match_idx and match_idx + seed_length - 1 <= right
+                                for left, right in covered.get(diagonal, [])):
+            continue
         query_left = query_idx
-        query_right = query_left + k - 1
+        query_right = query_left + seed_length - 1
+        if contig_index is None:
+            contig_start, contig_end = 0, ref_length
+        else:
+            contig_start, contig_end = contig_index.bounds(contig_index.contig_of(match_idx))
 
         tmp_score_left = 0
         current_score_left = 0
@@ -40,8 +75,8 @@ def ungapped_extension(query, matches_dict, reference_matrix_file, k, delta,
 
         tmp_score_right = 0
         current_score_right = 0
-        tmp_pos_right_ref = match_idx + k - 1
-        current_pos_right_ref = match_idx + k - 1
+        tmp_pos_right_ref = match_idx + seed_length - 1
+        current_pos_right_ref = match_idx + seed_length - 1
         tmp_pos_right_query = query_right
         current_pos_right_query = query_right
 
@@ -49,14 +84,11 @@ def ungapped_extension(query, matches_dict, reference_matrix_file, k, delta,
 
         # Left
         diff_left = current_score_left - tmp_score_left
-        while (diff_left > -delta) and (current_pos_left_ref > 0) and (current_pos_left_query > 0):
+        while (diff_left > -delta) and (current_pos_left_ref > contig_start) and (current_pos_left_query > 0):
             current_pos_left_ref -= 1
             current_pos_left_query -= 1
 
-            probas_ref = reference_matrix[current_pos_left_ref]
-            letter_query = query_one_hot[current_pos_left_query]
-            current_score_left += NT_SCORE_ALGORITHM[score_method](probas_ref, letter_query, mismatch_score,
-                                                                   substitution)
+            current_score_left += nt_score(current_pos_left_ref, current_pos_left_query)
 
             if current_score_left > tmp_score_left:
                 tmp_score_left = current_score_left
@@ -67,16 +99,12 @@ def ungapped_extension(query, matches_dict, reference_matrix_file, k, delta,
 
         # Right
         diff_right = current_score_right - tmp_score_right
-        while (diff_right > -delta) and (current_pos_right_ref < ref_length - 1) and (
+        while (diff_right > -delta) and (current_pos_right_ref < contig_end - 1) and (
                 current_pos_right_query < len(query) - 1):
             current_pos_right_ref += 1
             current_pos_right_query += 1
 
-            probas_ref = reference_matrix[current_pos_right_ref]
-            letter_query = query_one_hot[current_pos_right_query]
-
-            current_score_right += NT_SCORE_ALGORITHM[score_method](probas_ref, letter_query, mismatch_score,
-                                                                    substitution)
+            current_score_right += nt_score(current_pos_right_ref, current_pos_right_query)
 
             if current_score_right > tmp_score_right:
                 tmp_score_right = current_score_right
@@ -92,7 +120,142 @@ def ungapped_extension(query, matches_dict, reference_matrix_file, k, delta,
             'ref_right_idx': tmp_pos_right_ref,
             'score': tmp_score_left + tmp_score_right
         }
+        if score_seed:
+            # the seed is scored like the extensions, so long seeds weigh their whole span
+            seed_score = 0
+            for offset in range(seed_length):
+                seed_score += nt_score(match_idx + offset, query_idx + offset)
+            extension_result['seed_span_score'] = seed_score
+            extension_result['score'] = seed_score + tmp_score_left + tmp_score_right
+        match = seed_hit_match(matches_dict, idx)
         match['ungapped_extension_result'] = extension_result
         ungapped_extensions.append(match)
+        if skip_covered:
+            covered.setdefault(diagonal, []).append((tmp_pos_left_ref, tmp_pos_right_ref))
+
+    return ungapped_extensions
+
+
+def _xdrop(step_scores, max_steps, delta, step_chunk=DEFAULT_STEP_CHUNK):
+    """
+    X-drop extension of many seeds in one direction, same stopping rule and same float operations as the loop of
+    ungapped_extension, the steps are scored step_chunk at a time for the extensions which are not stopped yet
+    :param step_scores: function (extension ids, steps) -> [len(ids) x len(steps)] scores, steps start at 1
+    :param max_steps: number of steps before each extension reaches the query or contig end
+    :param delta: max allowed score drop before extension is stopped, positive value
+    :param step_chunk: number of steps scored at once
+    :return: best score (0 if no step improves it) and number of steps of the best score of each extension
+    """
+    best = np.zeros(len(max_steps))
+    best_steps = np.zeros(len(max_steps), dtype=np.int64)
+    current = np.zeros(len(max_steps))
+    running = np.flatnonzero(max_steps > 0)
+    start = 0
+    while len(running) > 0:
+        steps = start + np.arange(1, min(step_chunk, int(np.max(max_steps[running])) - start) + 1)
+        scores = step_scores(running, steps)
+        valid = steps[None, :] <= max_steps[running, None]
+
+        # cumulated scores and their running max, seeded with the state of the previous chunk
+        cumulated = np.cumsum(np.concatenate([current[running, None], scores], axis=1), axis=1)[:, 1:]
+        running_max = np.maximum.accumulate(np.concatenate([best[running, None], cumulated], axis=1), axis=1)
+        improved = cumulated > running_max[:, :-1]
+        running_max = running_max[:, 1:]
+
+        # an extension stops after the step where its score drops by delta or more, or at the last valid step
+        stop = ~valid | ((cumulated - running_max) <= -delta)
+        stopped = np.any(stop, axis=1)
+        first_stop = np.where(stopped, np.argmax(stop, axis=1), len(steps) - 1)
+        taken = np.arange(len(steps))[None, :] <= first_stop[:, None]
+
+        improved &= taken & valid
+        has_improved = np.any(improved, axis=1)
+        last_improved = len(steps) - 1 - np.argmax(improved[:, ::-1], axis=1)
+        rows = np.arange(len(running))
+        best[running] = np.where(has_improved, cumulated[rows, last_improved], best[running])
+        best_steps[running] = np.where(has_improved, steps[last_improved], best_steps[running])
+        current[running] = cumulated[rows, first_stop]
+
+        running = running[~stopped & (max_steps[running] > steps[-1])]
+        start = steps[-1]
+    return best, best_steps
+
 
+def batch_ungapped_extension(query, matches_dict, reference_matrix, k, delta,
+                             score_method, mismatch_score=1, substitution=dict(), contig_index=None,
+                             skip_covered=False, score_table=None, score_seed=False, step_chunk=DEFAULT_STEP_CHUNK):
+    """
+    ungapped extension of all the seed hits at once, same results as ungapped_extension
+    the left and right diagonals of the hits are scored as [#hits x step_chunk] arrays, the cumulated scores, their
+    running max and the delta drop off test are array operations
+    :param step_chunk: number of extension steps scored at once
+    see ungapped_extension for the other parameters
+    :return: ungapped_extensions dict (positions and scores)
+    """
+    assert score_method in NT_SCORE_ALGORITHM
+    reference_matrix = load_reference_matrix(reference_matrix)
+    if len(matches_dict) == 0:
+        return []
+
+    query_codes = sequence_codes(query)
+    query_idx, ref_idx, seed_length = seed_hit_columns(matches_dict, k)
+    if contig_index is None:
+        contig_start = np.zeros(len(ref_idx), dtype=np.int64)
+        contig_end = np.full(len(ref_idx), len(reference_matrix), dtype=np.int64)
+    else:
+        contig_ids = contig_index.contig_of(ref_idx)
+        contig_start, contig_end = contig_index.offsets[contig_ids], contig_index.offsets[contig_ids + 1]
+
+    def scorer(ref_base, query_base, direction):
+        def step_scores(ids, steps):
+            ref_positions = ref_base[ids, None] + direction * steps[None, :]
+            query_positions = query_base[ids, None] + direction * steps[None, :]
+            # steps past the end of an extension are scored anywhere and ignored
+            ref_positions = np.clip(ref_positions, 0, len(reference_matrix) - 1)
+            letters = query_codes[np.clip(query_positions, 0, len(query) - 1)]
+            if score_table is not None:
+                return score_table[ref_positions, letters]
+            scores = reference_score(reference_matrix, ref_positions.ravel(), letters.ravel(), score_method,
+                                     mismatch_score, substitution)
+            return scores.reshape(ref_positions.shape)
+        return step_scores
+
+    if score_seed:
+        # seed spans, summed in order like the loop of ungapped_extension
+        span_scores = scorer(ref_idx - 1, query_idx - 1, 1)(np.arange(len(ref_idx)),
+                                                            np.arange(1, np.max(seed_length) + 1))
+        seed_score = np.cumsum(span_scores, axis=1)[np.arange(len(ref_idx)), seed_length - 1]
+
+    right_ref = ref_idx + seed_length - 1
+    right_query = query_idx + seed_length - 1
+    left_score, left_steps = _xdrop(scorer(ref_idx, query_idx, -1),
+                                    np.minimum(query_idx, ref_idx - contig_start), delta, step_chunk)
+    right_score, right_steps = _xdrop(scorer(right_ref, right_query, 1),
+                                      np.minimum(len(query) - 1 - right_query, contig_end - 1 - right_ref), delta,
+                                      step_chunk)
+
+    ungapped_extensions = []
+    # diagonal (ref_idx - query_idx) -> reference spans of the extensions kept on it
+    covered = {}
+    for idx in range(len(query_idx)):
+        diagonal = ref_idx[idx] - query_idx[idx]
+        if skip_covered and any(left <= ref_idx[idx] and right_ref[idx] <= right
+                                for left, right in covered.get(diagonal, [])):
+            continue
+        extension_result = {
+            'query_left_idx': int(query_idx[idx] - left_steps[idx]),
+            'query_right_idx': int(right_query[idx] + right_steps[idx]),
+            'ref_left_idx': int(ref_idx[idx] - left_steps[idx]),
+            'ref_right_idx': int(right_ref[idx] + right_steps[idx]),
+            'score': left_score[idx] + right_score[idx]
+        }
+        if score_seed:
+            extension_result['seed_span_score'] = seed_score[idx]
+            extension_result['score'] = seed_score[idx] + left_score[idx] + right_score[idx]
+        match = seed_hit_match(matches_dict, idx)
+        match['ungapped_extension_result'] = extension_result
+        ungapped_extensions.append(match)
+        if skip_covered:
+            covered.setdefault(diagonal, []).append((extension_result['ref_left_idx'],
+                                                     extension_result['ref_right_idx']))
     return ungapped_extensions
@@ -1,29 +1,198 @@
+import os
+import itertools
 import numpy as np
 import pickle
 import argparse
-from src.utils import sequence_one_hot
+from src.utils.utils import sequence_codes
+from src.utils.reference_io import ContigIndex, write_reference_matrix, write_compact_reference
 
+# number of nucleotides decoded at once, bounds the memory used while building the reference matrix
+DEFAULT_CHUNK_SIZE = 1 << 20
 
-def generate_reference_seq_matrix(seq_file, prob_file, output_path, letters='ACGT'):
+
+def _iter_sequence_codes(seq_file, letters='ACGT', chunk_size=DEFAULT_CHUNK_SIZE):
     """
-    generate reference sequence matrix size [#NT x 4]
+    read the most likely sequence file block by block
+    :param seq_file: file of most likely sequence
+    :param letters: fix vocabulary in order
+    :param chunk_size: number of characters read at once
+    :return: generator of uint8 letter codes
+    """
+    with open(seq_file) as f:
+        while True:
+            block = f.read(chunk_size)
+            if block == '':
+                return
+            block = ''.join(block.split())
+            if len(block) > 0:
+                yield sequence_codes(block, letters)
+
+
+def _iter_probabilities(prob_file, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    read the space separated probability file block by block, a token cut by the block boundary is carried over
+    :param prob_file: probability of most likely sequence
+    :param chunk_size: number of characters read at once
+    :return: generator of float64 probabilities
+    """
+    leftover = ''
+    with open(prob_file) as f:
+        while True:
+            block = f.read(chunk_size)
+            if block == '':
+                break
+            tokens = (leftover + block).split()
+            leftover = ''
+            if len(tokens) > 0 and not block[-1].isspace():
+                leftover = tokens.pop()
+            if len(tokens) > 0:
+                yield np.array(tokens, dtype=np.float64)
+    if leftover != '':
+        yield np.array([leftover], dtype=np.float64)
+
+
+def _rechunk(blocks, chunk_size):
+    """
+    regroup a stream of 1D arrays into arrays of exactly chunk_size elements (except the last one)
+    :param blocks: iterable of 1D arrays
+    :param chunk_size: size of output arrays
+    :return: generator of arrays
+    """
+    pending = []
+    pending_size = 0
+    for block in blocks:
+        pending.append(block)
+        pending_size += len(block)
+        if pending_size < chunk_size:
+            continue
+        merged = np.concatenate(pending)
+        cut = len(merged) - len(merged) % chunk_size
+        for start in range(0, cut, chunk_size):
+            yield merged[start:start + chunk_size]
+        pending = [merged[cut:]]
+        pending_size = len(pending[0])
+    if pending_size > 0:
+        yield np.concatenate(pending)
+
+
+def count_sequence_length(seq_file, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    count the number of NT in the most likely sequence file without loading it
+    :param seq_file: file of most likely sequence
+    :param chunk_size: number of characters read at once
+    :return: number of NT
+    """
+    length = 0
+    with open(seq_file) as f:
+        while True:
+            block = f.read(chunk_size)
+            if block == '':
+                return length
+            length += len(''.join(block.split()))
+
+
+def iter_sequence_probabilities(seq_file, prob_file, letters='ACGT', chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    stream the most likely letters and their probabilities, sequence and probability files are read together
     :param seq_file: file of most likely sequence
     :param prob_file: probability of most likely sequence
     :param letters: fix vocabulary in order
+    :param chunk_size: number of NT per chunk
+    :return: generator of (uint8 letter codes, float64 probabilities) blocks of chunk_size NT
+    """
+    codes_stream = _rechunk(_iter_sequence_codes(seq_file, letters, chunk_size), chunk_size)
+    probs_stream = _rechunk(_iter_probabilities(prob_file, chunk_size), chunk_size)
+    for codes in codes_stream:
+        probs = next(probs_stream, np.zeros(0))
+        if len(probs) != len(codes):
+            raise ValueError('number of probabilities in {0} does not match {1}'.format(prob_file, seq_file))
+        yield codes, probs
+
+    if next(probs_stream, None) is not None:
+        raise ValueError('number of probabilities in {0} does not match {1}'.format(prob_file, seq_file))
+
+
+def iter_reference_chunks(seq_file, prob_file, letters='ACGT', chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    stream the reference sequence matrix
+    :param seq_file: file of most likely sequence
+    :param prob_file: probability of most likely sequence
+    :param letters: fix vocabulary in order
+    :param chunk_size: number of NT per chunk
+    :return: generator of consecutive [chunk_size x 4] blocks of the reference matrix
+    """
+    for codes, probs in iter_sequence_probabilities(seq_file, prob_file, letters, chunk_size):
+        # the most likely letter takes the probability, the other 3 letters share the rest
+        block = np.repeat(((1 - probs) / 3).reshape(-1, 1), len(letters), axis=1)
+        block[np.arange(len(codes)), codes] = probs
+        yield block
+
+
+def generate_reference_database(records, output_path, letters='ACGT', chunk_size=DEFAULT_CHUNK_SIZE,
+                                dtype='float64', layout='dense'):
+    """
+    generate one reference sequence matrix size [#NT x 4] out of several records concatenated in order
+    the records are streamed chunk by chunk into the binary reference format with their ContigIndex
+    (.npy and legacy .p outputs only support a single record)
+    :param records: list of (name, file of most likely sequence, probability of most likely sequence)
     :param output_path: saved data path
-    :return:
+    :param letters: fix vocabulary in order
+    :param chunk_size: number of NT decoded at once
+    :param dtype: stored float type, float32 or float64
+    :param layout: dense matrix or compact (2 bits letter + uint8 probability) form, see compact_reference.py
+    :return: ContigIndex of the records
     """
-    # load sequence to one hot encoding
-    seq = open(seq_file).readlines()[0]
-    seq = sequence_one_hot(seq, letters)
+    assert layout in ('dense', 'compact')
+    assert len(records) > 0
+    lengths = [count_sequence_length(seq_file, chunk_size) for _, seq_file, _ in records]
+    contig_index = ContigIndex.from_lengths([name for name, _, _ in records], lengths)
+
+    if output_path.endswith('.p') or output_path.endswith('.npy'):
+        assert len(records) == 1, 'multi record references need the binary reference format'
+    if output_path.endswith('.p'):
+        chunks = iter_reference_chunks(records[0][1], records[0][2], letters, chunk_size)
+        seq_matrix = np.concatenate(list(chunks)).astype(dtype)
+        pickle.dump(seq_matrix, open(output_path, 'wb'))
+        return contig_index
 
-    probs = open(prob_file).readlines()[0]
-    probs = [eval(x) for x in probs.split(' ')[:-1]]
-    probs = np.array(probs)
+    if layout == 'compact':
+        blocks = itertools.chain.from_iterable(
+            iter_sequence_probabilities(seq_file, prob_file, letters, chunk_size) for _, seq_file, prob_file in records
+        )
+        write_compact_reference(blocks, contig_index.length, output_path, contig_index=contig_index)
+    else:
+        chunks = itertools.chain.from_iterable(
+            iter_reference_chunks(seq_file, prob_file, letters, chunk_size) for _, seq_file, prob_file in records
+        )
+        write_reference_matrix(chunks, contig_index.length, output_path, dtype, len(letters),
+                               contig_index=contig_index)
+    return contig_index
 
-    rest_probs = (1 - probs) / 3
-    seq_matrix = probs.reshape(-1, 1) * seq + rest_probs.reshape(-1, 1) * (1 - seq)
-    pickle.dump(seq_matrix, open(output_path, 'wb'))
+
+def record_name(seq_file):
+    """
+    :param seq_file: file of most likely sequence
+    :return: default record name, file name without extension
+    """
+    return os.path.splitext(os.path.basename(seq_file))[0]
+
+
+def generate_reference_seq_matrix(seq_file, prob_file, output_path, letters='ACGT', chunk_size=DEFAULT_CHUNK_SIZE,
+                                  dtype='float64', layout='dense'):
+    """
+    generate reference sequence matrix size [#NT x 4]
+    the matrix is written chunk by chunk in the binary reference format (or .npy), .p outputs are legacy pickles
+    :param seq_file: file of most likely sequence
+    :param prob_file: probability of most likely sequence
+    :param letters: fix vocabulary in order
+    :param output_path: saved data path
+    :param chunk_size: number of NT decoded at once
+    :param dtype: stored float type, float32 or float64
+    :param layout: dense matrix or compact (2 bits letter + uint8 probability) form, see compact_reference.py
+    :return:
+    """
+    generate_reference_database([(record_name(seq_file), seq_file, prob_file)], output_path, letters, chunk_size,
+                                dtype, layout)
 
 
 def parse_args():
@@ -31,18 +200,45 @@ def parse_args():
     parser.add_argument(
         "--input_seq_path",
         type=str,
-        help="input probability sequence path"
+        nargs='+',
+        help="input probability sequence path, several paths build a multi record reference"
     )
     parser.add_argument(
         "--input_prob_path",
         type=str,
-        help="input probability sequence path"
+        nargs='+',
+        help="input probability sequence path, one per input sequence path"
+    )
+    parser.add_argument(
+        "--record_names",
+        type=str,
+        nargs='*',
+        help="name of each record, if None use the sequence file names",
+        default=None
     )
     parser.add_argument(
         "--output_path",
         type=str,
         help="output storage path",
     )
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        help="number of NT decoded at once",
+        default=DEFAULT_CHUNK_SIZE
+    )
+    parser.add_argument(
+        "--dtype",
+        type=str,
+        help="stored float type, float32 or float64",
+        default='float64'
+    )
+    parser.add_argument(
+        "--layout",
+        type=str,
+        help="dense matrix or compact form (2 bits letter + uint8 probability per NT)",
+        default='dense'
+    )
 
     args = parser.parse_args()
     return args
@@ -50,7 +246,14 @@ def parse_args():
 
 def main():
     args = parse_args()
-    generate_reference_seq_matrix(args.input_seq_path, args.input_prob_path, args.output_path)
+    assert len(args.input_seq_path) == len(args.input_prob_path)
+    names = args.record_names
+    if names is None:
+        names = [record_name(seq_file) for seq_file in args.input_seq_path]
+    assert len(names) == len(args.input_seq_path)
+    records = list(zip(names, args.input_seq_path, args.input_prob_path))
+    generate_reference_database(records, args.output_path, chunk_size=args.chunk_size, dtype=args.dtype,
+                                layout=args.layout)
 
 
 if __name__ == '__main__':
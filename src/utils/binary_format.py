@@ -0,0 +1,176 @@
+"""
+Versioned binary container for the data files of the project (reference matrix, seed index ...)
+
+file layout:
+    magic           8 bytes identifying the content of the file
+    version         uint32, version of the content format
+    header size     uint32
+    header          json {'meta': {...}, 'arrays': {name: {'dtype': ..., 'shape': ..., 'offset': ...}}}
+    arrays          raw C ordered arrays, each one starting on an ALIGNMENT bytes boundary
+
+arrays are opened with np.memmap, so opening a file costs O(1) whatever its size and the pages are shared
+between processes through the OS page cache
+
+files are written under a temporary name next to their path and renamed once complete, so a reader never sees a
+partially written file, even when several processes write the same file at once
+"""
+
+import os
+import json
+import struct
+import uuid
+import numpy as np
+
+ALIGNMENT = 64
+_PREFIX = struct.Struct('<8sII')
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _build_header(meta, specs):
+    """
+    build the json header, array offsets depend on the header size so iterate until it is stable
+    :param meta: json serializable dict
+    :param specs: list of (name, dtype, shape)
+    :return: header bytes, header dict
+    """
+    data_start = 0
+    while True:
+        arrays = {}
+        offset = data_start
+        for name, dtype, shape in specs:
+            dtype = np.dtype(dtype)
+            shape = [int(x) for x in shape]
+            arrays[name] = {'dtype': dtype.str, 'shape': shape, 'offset': offset}
+            offset = _align(offset + int(np.prod(shape)) * dtype.itemsize)
+        header = {'meta': meta, 'arrays': arrays}
+        header_bytes = json.dumps(header, sort_keys=True).encode('utf-8')
+        new_data_start = _align(_PREFIX.size + len(header_bytes))
+        if new_data_start == data_start:
+            return header_bytes, header
+        data_start = new_data_start
+
+
+class ArrayFileWriter(object):
+    """
+    write a container whose array shapes are known in advance, each array can be written chunk by chunk so the
+    whole data never needs to be in memory, the file only appears at path when it is closed complete
+    usage:
+        with ArrayFileWriter(path, magic, version, [('matrix', np.float64, (N, 4))]) as writer:
+            for chunk in chunks:
+                writer.write('matrix', chunk)
+    """
+
+    def __init__(self, path, magic, version, specs, meta=None):
+        assert len(magic) == 8
+        header_bytes, header = _build_header(meta if meta is not None else {}, specs)
+        self.path = path
+        self.tmp_path = '{0}.{1}.tmp'.format(path, uuid.uuid4().hex)
+        self.arrays = header['arrays']
+        self.written = {name: 0 for name in self.arrays}
+
+        end = _align(_PREFIX.size + len(header_bytes))
+        for spec in self.arrays.values():
+            end = max(end, spec['offset'] + int(np.prod(spec['shape'])) * np.dtype(spec['dtype']).itemsize)
+
+        self.file = open(self.tmp_path, 'xb')
+        self.file.write(_PREFIX.pack(magic, version, len(header_bytes)))
+        self.file.write(header_bytes)
+        self.file.truncate(end)
+
+    def write(self, name, chunk):
+        """
+        append chunk to array name, chunks are written in order along the first axis
+        :param name: array name
+        :param chunk: data
+        """
+        spec = self.arrays[name]
+        data = np.ascontiguousarray(chunk, dtype=np.dtype(spec['dtype'])).tobytes()
+        nbytes = int(np.prod(spec['shape'])) * np.dtype(spec['dtype']).itemsize
+        if self.written[name] + len(data) > nbytes:
+            raise ValueError('too much data written to array {0}'.format(name))
+        self.file.seek(spec['offset'] + self.written[name])
+        self.file.write(data)
+        self.written[name] += len(data)
+
+    def close(self):
+        self.file.close()
+        for name, spec in self.arrays.items():
+            nbytes = int(np.prod(spec['shape'])) * np.dtype(spec['dtype']).itemsize
+            if self.written[name] != nbytes:
+                self.discard()
+                raise ValueError('array {0} of {1} is incomplete'.format(name, self.path))
+        os.replace(self.tmp_path, self.path)
+
+    def discard(self):
+        """
+        drop the temporary file, path is left as it was
+        """
+        self.file.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.discard()
+            return False
+        self.close()
+        return False
+
+
+def write_array_file(path, magic, version, arrays, meta=None):
+    """
+    write in memory arrays into a container
+    :param path: output path
+    :param magic: 8 bytes content identifier
+    :param version: content format version
+    :param arrays: dict name -> array
+    :param meta: json serializable dict
+    """
+    specs = [(name, np.asarray(array).dtype, np.shape(array)) for name, array in arrays.items()]
+    with ArrayFileWriter(path, magic, version, specs, meta) as writer:
+        for name, array in arrays.items():
+            writer.write(name, array)
+
+
+def read_magic(path):
+    """
+    :param path: file path
+    :return: first 8 bytes of the file
+    """
+    with open(path, 'rb') as f:
+        return f.read(8)
+
+
+def open_array_file(path, magic, version, mode='r'):
+    """
+    open a container, arrays are memory mapped and not read
+    :param path: file path
+    :param magic: expected content identifier
+    :param version: expected content format version
+    :param mode: np.memmap mode
+    :return: meta dict, dict name -> array
+    """
+    with open(path, 'rb') as f:
+        file_magic, file_version, header_size = _PREFIX.unpack(f.read(_PREFIX.size))
+        if file_magic != magic:
+            raise ValueError('{0} is not a {1} file'.format(path, magic.decode('ascii')))
+        if file_version != version:
+            raise ValueError('{0} has format version {1}, expected {2}'.format(path, file_version, version))
+        header = json.loads(f.read(header_size).decode('utf-8'))
+
+    arrays = {}
+    for name, spec in header['arrays'].items():
+        dtype = np.dtype(spec['dtype'])
+        shape = tuple(spec['shape'])
+        if int(np.prod(shape)) == 0:
+            arrays[name] = np.zeros(shape, dtype=dtype)
+        else:
+            # plain ndarray view on the mapping, element access on np.memmap objects is slower
+            arrays[name] = np.asarray(np.memmap(path, dtype=dtype, mode=mode, offset=spec['offset'], shape=shape))
+    return header['meta'], arrays
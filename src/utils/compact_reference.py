@@ -0,0 +1,136 @@
+"""
+Compact representation of the reference sequence matrix
+
+each row of the reference matrix is (p for the most likely letter, (1 - p) / 3 for the 3 others), so it is stored as
+    - the most likely letter as a 2 bits code, 4 letters per byte
+    - p quantized in a uint8
+which takes 1.25 bytes per NT instead of 32 bytes for 4 float64
+"""
+
+import numpy as np
+
+# the .conf files have 2 decimals, with a 1/200 step they are stored and decoded exactly
+CONFIDENCE_SCALE = 200
+
+
+def pack_codes(codes):
+    """
+    pack 2 bits letter codes, 4 per byte, first letter in the lowest bits
+    :param codes: uint8 letter codes
+    :return: uint8 array of size ceil(len(codes) / 4)
+    """
+    codes = np.asarray(codes, dtype=np.uint8)
+    padded = np.zeros((len(codes) + 3) // 4 * 4, dtype=np.uint8)
+    padded[:len(codes)] = codes
+    padded = padded.reshape(-1, 4)
+    return padded[:, 0] | (padded[:, 1] << 2) | (padded[:, 2] << 4) | (padded[:, 3] << 6)
+
+
+def quantize_probabilities(probs, confidence_scale=CONFIDENCE_SCALE):
+    """
+    :param probs: probabilities of the most likely letters
+    :param confidence_scale: number of quantization steps
+    :return: uint8 quantized probabilities
+    """
+    assert confidence_scale <= 255
+    return np.clip(np.rint(np.asarray(probs) * confidence_scale), 0, confidence_scale).astype(np.uint8)
+
+
+class CompactReferenceMatrix(object):
+    """
+    reference matrix in compact form, behaves like the [#NT x 4] float64 matrix for indexing (rows are decoded on
+    demand) so it can be given to any blast stage, scoring kernels can work on codes() and probabilities() directly
+    """
+
+    def __init__(self, packed_codes, confidences, confidence_scale=CONFIDENCE_SCALE):
+        """
+        :param packed_codes: 2 bits codes of the most likely letters, see pack_codes
+        :param confidences: uint8 quantized probabilities of the most likely letters
+        :param confidence_scale: number of quantization steps
+        """
+        assert len(packed_codes) == (len(confidences) + 3) // 4
+        self.packed_codes = packed_codes
+        self.confidences = confidences
+        self.confidence_scale = confidence_scale
+        self.shape = (len(confidences), 4)
+        self.ndim = 2
+        self.dtype = np.dtype(np.float64)
+
+    @classmethod
+    def from_matrix(cls, reference_matrix, confidence_scale=CONFIDENCE_SCALE):
+        """
+        build the compact form of a dense reference matrix
+        :param reference_matrix: [#NT x 4] reference matrix
+        :param confidence_scale: number of quantization steps
+        :return: CompactReferenceMatrix
+        """
+        reference_matrix = np.asarray(reference_matrix)
+        # the most likely letter is the odd one out, it is the minimum of the row when p < 1/4
+        row_max = np.max(reference_matrix, axis=1, keepdims=True)
+        single_max = np.sum(reference_matrix == row_max, axis=1) == 1
+        codes = np.where(single_max, np.argmax(reference_matrix, axis=1), np.argmin(reference_matrix, axis=1))
+        probs = reference_matrix[np.arange(len(codes)), codes]
+        return cls(pack_codes(codes), quantize_probabilities(probs, confidence_scale), confidence_scale)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _positions(self, key):
+        if isinstance(key, slice):
+            return np.arange(*key.indices(len(self)))
+        positions = np.asarray(key)
+        if positions.dtype == np.bool_:
+            return np.nonzero(positions)[0]
+        return np.where(positions < 0, positions + len(self), positions)
+
+    def codes(self, key):
+        """
+        :param key: position, slice or array of positions
+        :return: 2 bits codes of the most likely letters
+        """
+        positions = self._positions(key)
+        return (self.packed_codes[positions >> 2] >> ((positions & 3) << 1).astype(np.uint8)) & 3
+
+    def probabilities(self, key):
+        """
+        :param key: position, slice or array of positions
+        :return: float64 probabilities of the most likely letters
+        """
+        return self.confidences[self._positions(key)] / self.confidence_scale
+
+    def argmax_codes(self, key):
+        """
+        same result as np.argmax on the decoded rows
+        :param key: position, slice or array of positions
+        :return: letter codes
+        """
+        codes = self.codes(key)
+        probs = self.probabilities(key)
+        rest = (1 - probs) / 3
+        first_other = (codes == 0).astype(np.uint8)
+        return np.where(probs > rest, codes, np.where(probs < rest, first_other, 0)).astype(np.uint8)
+
+    def rows(self, key):
+        """
+        decode rows of the reference matrix
+        :param key: slice or array of positions
+        :return: [n x 4] float64 matrix
+        """
+        codes = self.codes(key)
+        probs = self.probabilities(key)
+        rows = np.repeat(((1 - probs) / 3).reshape(-1, 1), self.shape[1], axis=1)
+        rows[np.arange(len(codes)), codes] = probs
+        return rows
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            return self[key[0]][(Ellipsis,) + key[1:]]
+        if isinstance(key, (int, np.integer)):
+            if not -len(self) <= key < len(self):
+                raise IndexError('index {0} is out of bounds for reference of size {1}'.format(key, len(self)))
+            return self.rows(np.array([key]))[0]
+        return self.rows(key)
+
+    def __array__(self, dtype=None, copy=None):
+        rows = self.rows(slice(None))
+        return rows if dtype is None else rows.astype(dtype)
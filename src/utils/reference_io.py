@@ -0,0 +1,247 @@
+"""
+Storage of the reference sequence matrix, shared by preprocessing and all blast stages
+
+supported files:
+    - binary reference format (see src/utils/binary_format.py), memory mapped, default output of preprocessing
+      the matrix is either stored densely or in compact form (see src/utils/compact_reference.py)
+    - .npy, memory mapped
+    - .p legacy pickle, fully loaded
+
+a binary reference can hold several records (chromosomes, ancestral blocks ...) concatenated in one matrix, their
+names and sorted start offsets are stored with it and loaded as a ContigIndex
+"""
+
+import pickle
+import numpy as np
+from src.utils.binary_format import ArrayFileWriter, open_array_file, read_magic
+from src.utils.compact_reference import CompactReferenceMatrix, CONFIDENCE_SCALE, pack_codes, quantize_probabilities
+
+REFERENCE_MAGIC = b'REFMATRX'
+REFERENCE_FORMAT_VERSION = 1
+_NPY_MAGIC = b'\x93NUMPY'
+
+
+class ContigIndex(object):
+    """
+    sorted start offsets of the records concatenated in a reference matrix, maps global reference positions to
+    (contig, local position)
+    """
+
+    def __init__(self, names, offsets):
+        """
+        :param names: record names
+        :param offsets: int64 array of size len(names) + 1, start of each record then total length
+        """
+        offsets = np.asarray(offsets, dtype=np.int64)
+        assert len(offsets) == len(names) + 1 and offsets[0] == 0 and np.all(np.diff(offsets) >= 0)
+        self.names = list(names)
+        self.offsets = offsets
+
+    @classmethod
+    def single(cls, length, name='reference'):
+        """
+        :param length: reference length
+        :param name: record name
+        :return: index of a reference made of one record
+        """
+        return cls([name], [0, length])
+
+    @classmethod
+    def from_lengths(cls, names, lengths):
+        """
+        :param names: record names
+        :param lengths: record lengths, in order of concatenation
+        :return: ContigIndex
+        """
+        return cls(names, np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)]))
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def length(self):
+        return int(self.offsets[-1])
+
+    def contig_of(self, positions):
+        """
+        :param positions: global reference position(s)
+        :return: contig id(s)
+        """
+        return np.searchsorted(self.offsets, positions, side='right') - 1
+
+    def bounds(self, contig_id):
+        """
+        :param contig_id: contig id
+        :return: global start (included) and end (excluded) of the contig
+        """
+        return int(self.offsets[contig_id]), int(self.offsets[contig_id + 1])
+
+    def locate(self, position):
+        """
+        :param position: global reference position
+        :return: contig name, position inside the contig
+        """
+        contig_id = int(self.contig_of(position))
+        return self.names[contig_id], int(position) - int(self.offsets[contig_id])
+
+    def tail(self, start):
+        """
+        :param start: global reference position
+        :return: ContigIndex of the positions start .. length - 1, with positions relative to start
+        """
+        assert 0 <= start < self.length
+        first = int(self.contig_of(start))
+        return ContigIndex(self.names[first:], np.concatenate([[0], self.offsets[first + 1:] - start]))
+
+    def window_mask(self, k):
+        """
+        :param k: window size
+        :return: boolean array over window starts 0 .. length - k, True when the window stays inside one contig
+        """
+        mask = np.zeros(max(self.length - k + 1, 0), dtype=bool)
+        for contig_id in range(len(self)):
+            start, end = self.bounds(contig_id)
+            mask[start:max(end - k + 1, start)] = True
+        return mask
+
+
+def _with_contigs(specs, meta, contig_index):
+    if contig_index is None:
+        return specs, meta
+    meta = dict(meta if meta is not None else {}, contigs=contig_index.names)
+    return specs + [('contig_offsets', np.int64, contig_index.offsets.shape)], meta
+
+
+def write_reference_matrix(chunks, length, output_path, dtype=np.float64, width=4, meta=None, contig_index=None):
+    """
+    write the reference matrix chunk by chunk
+    :param chunks: iterable of consecutive [n x width] blocks of the matrix
+    :param length: total number of NT
+    :param output_path: output path, .npy outputs are written as numpy files, others in the binary reference format
+    :param dtype: stored float type (float32 or float64)
+    :param width: number of letters
+    :param meta: extra json serializable information stored in the header
+    :param contig_index: ContigIndex of the records in the matrix, not stored in .npy files
+    """
+    dtype = np.dtype(dtype)
+    assert dtype in (np.dtype(np.float32), np.dtype(np.float64))
+
+    if output_path.endswith('.npy'):
+        header = {
+            'descr': np.lib.format.dtype_to_descr(dtype),
+            'fortran_order': False,
+            'shape': (length, width)
+        }
+        with open(output_path, 'wb') as f:
+            np.lib.format.write_array_header_1_0(f, header)
+            for block in chunks:
+                f.write(np.ascontiguousarray(block, dtype=dtype).tobytes())
+        return
+
+    specs, meta = _with_contigs([('matrix', dtype, (length, width))], meta, contig_index)
+    with ArrayFileWriter(output_path, REFERENCE_MAGIC, REFERENCE_FORMAT_VERSION, specs, meta) as writer:
+        for block in chunks:
+            writer.write('matrix', block)
+        if contig_index is not None:
+            writer.write('contig_offsets', contig_index.offsets)
+
+
+def write_compact_reference(records, length, output_path, confidence_scale=CONFIDENCE_SCALE, meta=None,
+                            contig_index=None):
+    """
+    write the reference matrix in compact form chunk by chunk
+    :param records: iterable of consecutive (letter codes, probabilities of the letters) blocks
+    :param length: total number of NT
+    :param output_path: output path
+    :param confidence_scale: number of quantization steps of the probabilities
+    :param meta: extra json serializable information stored in the header
+    :param contig_index: ContigIndex of the records in the matrix
+    """
+    meta = dict(meta if meta is not None else {}, layout='compact', confidence_scale=confidence_scale)
+    specs = [('codes', np.uint8, ((length + 3) // 4,)), ('confidences', np.uint8, (length,))]
+    specs, meta = _with_contigs(specs, meta, contig_index)
+    with ArrayFileWriter(output_path, REFERENCE_MAGIC, REFERENCE_FORMAT_VERSION, specs, meta) as writer:
+        # 4 codes are packed per byte, codes which do not fill a byte are carried over to the next block
+        carry = np.zeros(0, dtype=np.uint8)
+        for codes, probs in records:
+            codes = np.concatenate([carry, codes])
+            cut = len(codes) - len(codes) % 4
+            writer.write('codes', pack_codes(codes[:cut]))
+            carry = codes[cut:]
+            writer.write('confidences', quantize_probabilities(probs, confidence_scale))
+        if len(carry) > 0:
+            writer.write('codes', pack_codes(carry))
+        if contig_index is not None:
+            writer.write('contig_offsets', contig_index.offsets)
+
+
+def save_reference_matrix(reference_matrix, output_path, dtype=None, meta=None, contig_index=None):
+    """
+    write an in memory reference matrix in the binary reference format
+    :param reference_matrix: [#NT x 4] matrix or CompactReferenceMatrix
+    :param output_path: output path
+    :param dtype: stored float type of dense matrices, if None keep the matrix type
+    :param meta: extra json serializable information stored in the header
+    :param contig_index: ContigIndex of the records in the matrix
+    """
+    if isinstance(reference_matrix, CompactReferenceMatrix):
+        meta = dict(meta if meta is not None else {}, layout='compact',
+                    confidence_scale=reference_matrix.confidence_scale)
+        specs = [('codes', np.uint8, reference_matrix.packed_codes.shape),
+                 ('confidences', np.uint8, reference_matrix.confidences.shape)]
+        specs, meta = _with_contigs(specs, meta, contig_index)
+        with ArrayFileWriter(output_path, REFERENCE_MAGIC, REFERENCE_FORMAT_VERSION, specs, meta) as writer:
+            writer.write('codes', reference_matrix.packed_codes)
+            writer.write('confidences', reference_matrix.confidences)
+            if contig_index is not None:
+                writer.write('contig_offsets', contig_index.offsets)
+        return
+
+    dtype = reference_matrix.dtype if dtype is None else dtype
+    write_reference_matrix([reference_matrix], reference_matrix.shape[0], output_path, dtype,
+                           reference_matrix.shape[1], meta, contig_index)
+
+
+def open_reference_matrix(path):
+    """
+    memory map a reference matrix stored in the binary reference format
+    :param path: file path
+    :return: meta dict, read only [#NT x 4] matrix or CompactReferenceMatrix
+    """
+    meta, arrays = open_array_file(path, REFERENCE_MAGIC, REFERENCE_FORMAT_VERSION)
+    if meta.get('layout', 'dense') == 'compact':
+        return meta, CompactReferenceMatrix(arrays['codes'], arrays['confidences'], meta['confidence_scale'])
+    return meta, arrays['matrix']
+
+
+def load_reference_matrix(reference):
+    """
+    loader shared by the blast stages
+    :param reference: reference matrix file (binary reference format, .npy or legacy pickle), or an already loaded
+    matrix which is returned as it is
+    :return: [#NT x 4] reference matrix or CompactReferenceMatrix
+    """
+    if not isinstance(reference, str):
+        return reference
+
+    magic = read_magic(reference)
+    if magic == REFERENCE_MAGIC:
+        return open_reference_matrix(reference)[1]
+    if magic.startswith(_NPY_MAGIC):
+        return np.asarray(np.load(reference, mmap_mode='r'))
+    return pickle.load(open(reference, 'rb'))
+
+
+def load_contig_index(reference, reference_matrix=None):
+    """
+    :param reference: reference matrix file, or an already loaded matrix
+    :param reference_matrix: loaded matrix of reference, avoids loading it again for files without stored records
+    :return: ContigIndex, references without stored records are made of a single record
+    """
+    if isinstance(reference, str) and read_magic(reference) == REFERENCE_MAGIC:
+        meta, arrays = open_array_file(reference, REFERENCE_MAGIC, REFERENCE_FORMAT_VERSION)
+        if 'contigs' in meta:
+            return ContigIndex(meta['contigs'], arrays['contig_offsets'])
+    if reference_matrix is None:
+        reference_matrix = load_reference_matrix(reference)
+    return ContigIndex.single(len(reference_matrix))
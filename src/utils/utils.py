@@ -37,6 +37,36 @@ def seq2num(seq, letters='ACGT'):
     return seq
 
 
+def reverse_complement(seq, letters='ACGT', complements='TGCA'):
+    """
+    reverse complement of a sequence, letters outside of letters are kept as they are
+    :param seq: raw sequence
+    :param letters: letters in order
+    :param complements: complement of each letter
+    :return: reverse complement sequence
+    """
+    return seq[::-1].translate(str.maketrans(letters, complements))
+
+
+def sequence_codes(seq, letters='ACGT', invalid_code=None):
+    """
+    generate numerical representation of input sequence, vectorized version of seq2num
+    :param seq: raw sequence (str or bytes)
+    :param letters: letters in order
+    :param invalid_code: code given to letters outside of letters, if None such letters raise a ValueError
+    :return: uint8 numerical array
+    """
+    lookup = np.full(256, 255 if invalid_code is None else invalid_code, dtype=np.uint8)
+    for idx, letter in enumerate(letters):
+        lookup[ord(letter)] = idx
+    if isinstance(seq, str):
+        seq = seq.encode('ascii')
+    codes = lookup[np.frombuffer(seq, dtype=np.uint8)]
+    if invalid_code is None and np.any(codes == 255):
+        raise ValueError('sequence contains letters outside of {0}'.format(letters))
+    return codes
+
+
 def generate_sequence(possible_letters_dict, fixed_length, saved_strings,
                       current_string, characters="ACGT"):
     """